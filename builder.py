@@ -1,8 +1,54 @@
 """
 src配下のファイルを一つのファイルにくっつける処理を行う。
+くっつけたファイルは、バイトコードにコンパイルしてzipappにもまとめる。
 """
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, List, Set, Tuple
+import argparse
+import ast
+import importlib.util
+import py_compile
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipapp
+
+# 起動時には読み込まず、初めて使われた時に読み込む重い依存ライブラリ
+HEAVY_MODULES = ["PIL", "pdf2image", "pefile"]
+
+LAZY_IMPORT_HELPER = '''
+
+def _lazy_import(name: str) -> ModuleType:
+    """ 属性に初めてアクセスした時に実行されるモジュールを返す """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    parent_name, _, child_name = name.rpartition(".")
+    if parent_name:
+        setattr(sys.modules[parent_name], child_name, module)
+    return module
+
+'''
+
+LAZY_IMPORT_HELPER_IMPORTS = ["import importlib.util\n", "import sys\n", "from types import ModuleType\n"]
+
+ZIPAPP_MAIN = '''from imgconv import main
+
+if __name__ == '__main__':
+    main()
+'''
 
 
 def merge_import_statements(import_states: List[str], lib_names: List[str]) -> List[str]:
@@ -13,9 +59,9 @@ def merge_import_statements(import_states: List[str], lib_names: List[str]) -> L
         lib_names (List[str], optional): importで無視すべきモジュールのリスト.
 
     Returns:
-        List[str]: 同一モジュールからのimportをくっつけたimport文のリスト
+        List[str]: 同一モジュールからのimportをくっつけたimport文のリスト. ビルドの度に順番が変わらないよう、ソートしておく。
     """
-    import_states = list(set(import_states))
+    import_states = sorted(set(import_states))
     from_import_states_holder: Dict[str, List[str]] = {}
 
     result_import_statements = []
@@ -39,17 +85,93 @@ def merge_import_statements(import_states: List[str], lib_names: List[str]) -> L
             result_import_statements.append(state)
 
     for lib_name, import_list in from_import_states_holder.items():
-        imps = list(set(import_list))
+        imps = sorted(set(import_list))
         import_state = ", ".join(imps)
         state = f"from {lib_name} import {import_state}\n"
         result_import_statements.append(state)
 
-    return result_import_statements
+    return sorted(result_import_statements)
 
 
 def delete_block_comment(codes: List[str]) -> List[str]:
-    """ \"\"\"で定義されるコメント行を消去する """
-    # TODO 実装
+    """ \"\"\"で定義されるコメント行を消去する. ライセンス表記を残すため、モジュールのdocstringは消さない。 """
+    tree = ast.parse("".join(codes))
+    replaced: Dict[int, str] = {}
+
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            continue
+
+        docstring = node.body[0]
+        if not (isinstance(docstring, ast.Expr) and isinstance(docstring.value, ast.Constant)
+                and isinstance(docstring.value.value, str)):
+            continue
+
+        if docstring.lineno == node.lineno or docstring.end_lineno is None:
+            # def f(): """..."""のように1行で書かれている時
+            continue
+
+        for lineno in range(docstring.lineno, docstring.end_lineno + 1):
+            replaced[lineno] = ""
+
+        if len(node.body) == 1:
+            # docstringしか無い時は、空にならないようpassを置く
+            indent = codes[docstring.lineno - 1][:docstring.col_offset]
+            replaced[docstring.lineno] = f"{indent}pass\n"
+
+    return [replaced.get(lineno, row) for lineno, row in enumerate(codes, start=1)]
+
+
+def is_heavy_module(lib_name: str) -> bool:
+    """ 起動時に読み込むべきでない重いモジュールか """
+    return lib_name.split(".")[0] in HEAVY_MODULES
+
+
+def build_import_graph(import_states: List[str]) -> Dict[str, List[str]]:
+    """import文を、起動時に読み込むものと遅延して読み込むものに分ける
+
+    Args:
+        import_states (List[str]): merge_import_statementsで整理したimport文のリスト
+
+    Returns:
+        Dict[str, List[str]]: "eager"には起動時に実行するimport文、"lazy"には遅延して読み込むモジュール名が入る。
+    """
+    graph: Dict[str, List[str]] = {"eager": [], "lazy": []}
+
+    for state in import_states:
+        splitted = state.split(" ")
+        lib_name = splitted[1].strip()
+        if not is_heavy_module(lib_name):
+            graph["eager"].append(state)
+
+        elif state.startswith("import"):
+            graph["lazy"].append(lib_name)
+
+        else:
+            # from PIL import Image のような時、サブモジュールは遅延して読み込み、それ以外の名前は起動時に読み込む
+            eager_imps = []
+            imps = state[state.index("import") + len("import "):].replace("\n", "").split(", ")
+            for imp in imps:
+                if importlib.util.find_spec(f"{lib_name}.{imp}") is not None:
+                    graph["lazy"].append(f"{lib_name}.{imp}")
+                else:
+                    eager_imps.append(imp)
+
+            if eager_imps:
+                graph["eager"].append(f"from {lib_name} import {', '.join(eager_imps)}\n")
+
+    return graph
+
+
+def get_lazy_import_codes(graph: Dict[str, List[str]]) -> List[str]:
+    """ 遅延して読み込むモジュールを束縛するコードを返す """
+    if not graph["lazy"]:
+        return []
+
+    codes = [LAZY_IMPORT_HELPER]
+    for lib_name in sorted(graph["lazy"]):
+        codes.append(f"{lib_name.split('.')[-1]} = _lazy_import(\"{lib_name}\")\n")
+    codes.append("\n\n")
     return codes
 
 
@@ -69,21 +191,38 @@ def get_codes_with_splitted_import_states(file: Path) -> Tuple[List[str], List[s
     return import_statements, codes
 
 
-def main():
-    """ エントリーポイント """
+def build_zipapp(module_file: Path, target: Path):
+    """ バイトコードにコンパイルしたモジュールをzipappにまとめる """
+    with tempfile.TemporaryDirectory() as tmp:
+        app_dir = Path(tmp)
+        # docstringとassertを取り除いてコンパイルする. ソースが無いので、更新チェックもしない
+        py_compile.compile(
+            str(module_file), cfile=str(app_dir / "imgconv.pyc"), dfile="imgconv.py", doraise=True, optimize=2,
+            invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        (app_dir / "__main__.py").write_text(ZIPAPP_MAIN, encoding="utf-8")
+
+        zipapp.create_archive(app_dir, target, interpreter="/usr/bin/env python3")
+
+
+def build(dist: Path, pyz: Path) -> Dict[str, List[str]]:
+    """src配下のファイルを一つにまとめ、zipappを作る
+
+    Returns:
+        Dict[str, List[str]]: import文の依存関係. build_import_graphの返り値。
+    """
     src = Path("./src")
 
     main_file = src / "main.py"
-    dist = Path("dist/imgconv/main.py")
 
     import_statements: List[str]
     main_code: List[str]
 
     import_statements, main_code = get_codes_with_splitted_import_states(main_file)
+    main_code = delete_block_comment(main_code)
 
     lib_src_codes: List[str] = []
 
-    libs = src.glob("*.py")
+    libs = sorted(src.glob("*.py"))
     lib_names: List[str] = []
 
     for lib in libs:
@@ -98,11 +237,124 @@ def main():
     # import文を整理
     import_statements = merge_import_statements(import_statements, lib_names)
 
-    new_code = f"{''.join(import_statements)}{''.join(lib_src_codes)}{''.join(main_code)}"
+    # 重いライブラリは遅延して読み込む
+    graph = build_import_graph(import_statements)
+    lazy_import_codes = get_lazy_import_codes(graph)
+    eager_statements = graph["eager"]
+    if lazy_import_codes:
+        eager_statements = merge_import_statements(eager_statements + LAZY_IMPORT_HELPER_IMPORTS, [])
+
+    for state in sorted(eager_statements):
+        print(f"[eager] {state.strip()}")
+    for lib_name in sorted(graph["lazy"]):
+        print(f"[lazy]  {lib_name}")
+
+    # 型ヒントで遅延したモジュールの属性を参照しても、読み込まれないようにする
+    header = "from __future__ import annotations\n"
+    new_code = (f"{header}{''.join(eager_statements)}{''.join(lazy_import_codes)}"
+                f"{''.join(lib_src_codes)}{''.join(main_code)}")
 
-    with open(dist, "w", encoding="utf-8") as f:
+    # 既存の成果物に合わせ、どの環境でビルドしてもCRLFで書き出す
+    with open(dist, "w", encoding="utf-8", newline="\r\n") as f:
         f.writelines(new_code)
 
+    build_zipapp(dist, pyz)
+
+    return graph
+
+
+def measure_startup(command: List[str], repeat: int) -> float:
+    """ コマンドを新しいプロセスで実行し、ヘルプを表示するまでの時間の中央値を返す """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([*command, "-h"], check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+
+def get_startup_imports(command: List[str]) -> Set[str]:
+    """ ヘルプを表示するまでに読み込まれたモジュール名を返す """
+    result = subprocess.run([command[0], "-X", "importtime", *command[1:], "-h"],
+                            check=True, capture_output=True, text=True)
+    modules = set()
+    for row in result.stderr.splitlines():
+        if row.startswith("import time:") and "|" in row:
+            modules.add(row.split("|")[-1].strip())
+
+    return modules
+
+
+def check(pyz: Path, lazy_modules: List[str], repeat: int) -> bool:
+    """ビルドしたzipappの起動時間と動作が、srcから実行した時と一致するかを確認する
+
+    Args:
+        pyz (Path): ビルドしたzipapp
+        lazy_modules (List[str]): 起動時に読み込まれてはいけないモジュール
+        repeat (int): 起動時間を計測する回数
+
+    Returns:
+        bool: 問題が無ければTrue
+    """
+    src_command = [sys.executable, str(Path("src/main.py"))]
+    pyz_command = [sys.executable, str(pyz)]
+    ok = True
+
+    src_help = subprocess.run([*src_command, "-h"], check=True, capture_output=True, text=True).stdout
+    pyz_help = subprocess.run([*pyz_command, "-h"], check=True, capture_output=True, text=True).stdout
+    if src_help != pyz_help:
+        print("[NG] the help messages are different.")
+        ok = False
+
+    heavy_imports = sorted(m for m in get_startup_imports(pyz_command)
+                           if any(m == lazy or m.startswith(f"{lazy}.") for lazy in lazy_modules))
+    if heavy_imports:
+        print(f"[NG] heavy modules are imported at startup: {', '.join(heavy_imports)}")
+        ok = False
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for img_input, options in [(Path("example/single_color.jpg"), ["--crop", "--round"]),
+                                   (Path("example/hakase4_laugh.png"), ["--crop"])]:
+            outputs = []
+            for name, command in [("src", src_command), ("pyz", pyz_command)]:
+                img_output = Path(tmp) / f"{name}_{img_input.stem}.ico"
+                subprocess.run([*command, "-i", str(img_input.absolute()), "-o", str(img_output), *options],
+                               check=True, capture_output=True)
+                outputs.append(img_output.read_bytes() if img_output.exists() else None)
+
+            if outputs[0] is None or outputs[0] != outputs[1]:
+                print(f"[NG] the outputs converted from {img_input} are different.")
+                ok = False
+
+    src_time = measure_startup(src_command, repeat)
+    pyz_time = measure_startup(pyz_command, repeat)
+    print(f"cold start: src {src_time * 1000:.1f} ms, pyz {pyz_time * 1000:.1f} ms")
+    if pyz_time > src_time * 1.1:
+        print("[NG] the built artifact starts slower than src.")
+        ok = False
+
+    if ok:
+        print("[OK] the built artifact behaves the same as src.")
+
+    return ok
+
+
+def main():
+    """ エントリーポイント """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check", action="store_true", help="ビルド後、起動時間と動作がsrcと一致するか確認する。")
+    parser.add_argument("--repeat", type=int, default=5, help="起動時間を計測する回数。")
+    args = parser.parse_args()
+
+    dist = Path("dist/imgconv/main.py")
+    pyz = Path("dist/imgconv.pyz")
+
+    graph = build(dist, pyz)
+
+    if args.check and not check(pyz, graph["lazy"], args.repeat):
+        sys.exit(1)
+
 
 if __name__ == '__main__':
     main()
@@ -1,32 +1,353 @@
-import pefile
-import pdf2image
+from __future__ import annotations
+from PIL import UnidentifiedImageError
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import ExitStack, nullcontext
+from functools import partial
+from multiprocessing.connection import Connection
+from pathlib import Path, PurePath, PurePosixPath, PureWindowsPath
+from types import ModuleType
+from typing import Any, BinaryIO, Callable, Dict, FrozenSet, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
 import argparse
+import importlib.util
 import io
 import logging
+import lzma
+import multiprocessing
+import os
+import shutil
+import signal
 import struct
-from PIL import ImageFilter, UnidentifiedImageError, ImageDraw, Image
-from typing import Any, NamedTuple, Union, List, Optional, Dict
-from pathlib import Path
+import sys
+import tarfile
+import time
+import zipfile
+import zlib
+
+
+def _lazy_import(name: str) -> ModuleType:
+    """ 属性に初めてアクセスした時に実行されるモジュールを返す """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    parent_name, _, child_name = name.rpartition(".")
+    if parent_name:
+        setattr(sys.modules[parent_name], child_name, module)
+    return module
+
+Image = _lazy_import("PIL.Image")
+ImageDraw = _lazy_import("PIL.ImageDraw")
+ImageFilter = _lazy_import("PIL.ImageFilter")
+pdf2image = _lazy_import("pdf2image")
+pefile = _lazy_import("pefile")
+
+
+"""
+zip/tarアーカイブのメンバーを、ディスクに展開せずに読み書きするモジュール。
+"""
+
+# アーカイブの拡張子と、tarfile.openに渡す書き込みモード. zipはNone
+ARCHIVE_SUFFIXES = {
+    ".zip": None,
+    ".tar": "w",
+    ".tar.gz": "w:gz",
+    ".tgz": "w:gz",
+    ".tar.bz2": "w:bz2",
+    ".tbz2": "w:bz2",
+    ".tar.xz": "w:xz",
+    ".txz": "w:xz",
+}
+
+# 壊れた・途中で切れたアーカイブを読んだ時に送出されるエラー
+ARCHIVE_ERRORS = (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError, zlib.error, lzma.LZMAError)
+
+
+def get_archive_suffix(path: PurePath) -> Optional[str]:
+    name = path.name.lower()
+    for suffix in ARCHIVE_SUFFIXES:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return suffix
+
+    return None
+
+
+def is_archive(path: PurePath) -> bool:
+    return get_archive_suffix(path) is not None
+
+
+def split_archive_path(out: str) -> Tuple[Optional[Path], str]:
+    parts = out.replace("\\", "/").split("/")
+    for i, part in enumerate(parts):
+        if not is_archive(PurePosixPath(part)):
+            continue
+
+        member = "/".join(parts[i + 1:])
+        if not member:
+            raise ValueError(f"specify the member name in the archive, such as {out}/${{stem}}.png")
+        return Path("/".join(parts[:i + 1])), member
+
+    return None, out
+
+
+def to_member_path(path: Path) -> PurePosixPath:
+    try:
+        relative = path.absolute().relative_to(Path.cwd())
+    except ValueError:
+        relative = Path(*path.absolute().parts[1:])
+
+    return PurePosixPath(relative.as_posix())
+
+
+def is_safe_member(member: PurePosixPath) -> bool:
+    # Windowsのドライブ名やバックスラッシュ区切りも考慮する
+    windows_path = PureWindowsPath(str(member))
+    if member.is_absolute() or windows_path.drive or windows_path.root:
+        return False
+
+    return ".." not in member.parts and ".." not in windows_path.parts
+
+
+def iter_archive_members(path: Path) -> Iterator[Tuple[PurePosixPath, BinaryIO]]:
+    if get_archive_suffix(path) == ".zip":
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                with zf.open(info) as stream:
+                    yield PurePosixPath(info.filename), stream
+
+    else:
+        with tarfile.open(path, "r|*") as tf:
+            for member in tf:
+                if not member.isfile():
+                    continue
+                stream = tf.extractfile(member)
+                if stream is not None:
+                    yield PurePosixPath(member.name), stream
+
+
+def is_valid_archive(path: Path) -> bool:
+    if get_archive_suffix(path) == ".zip":
+        return zipfile.is_zipfile(path)
+
+    return tarfile.is_tarfile(path)
+
+
+class ArchiveWriter:
+
+    def __init__(self, path: Path) -> None:
+        suffix = get_archive_suffix(path)
+        if suffix is None:
+            raise ValueError(f"{path} is not an archive.")
+
+        if path.exists() and not is_valid_archive(path):
+            raise ValueError(f"{path} already exists, but it is not a valid archive.")
+
+        self.path = path
+        self._tmp = path.with_name(f".{path.name}.tmp")
+        self._names: Set[str] = set()
+        self._zip: Optional[zipfile.ZipFile] = None
+        self._tar: Optional[tarfile.TarFile] = None
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        mode = ARCHIVE_SUFFIXES[suffix]
+        if mode is None:
+            self._zip = zipfile.ZipFile(self._tmp, "w", compression=zipfile.ZIP_DEFLATED)
+        else:
+            self._tar = tarfile.open(self._tmp, mode)     # pylint: disable=consider-using-with
+
+    def __enter__(self) -> "ArchiveWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def write(self, name: str, data: bytes) -> bool:
+        name = PurePosixPath(name).as_posix()
+        if name in self._names:
+            return False
+        self._names.add(name)
+
+        if self._zip is not None:
+            self._zip.writestr(name, data)
+
+        elif self._tar is not None:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self._tar.addfile(info, io.BytesIO(data))
+
+        return True
+
+    def close(self):
+        if self._zip is None and self._tar is None:
+            return
+
+        try:
+            if self.path.exists():
+                for member, stream in iter_archive_members(self.path):
+                    # 今回書き込んだメンバーは、writeが上書きせずにFalseを返す
+                    self.write(member.as_posix(), stream.read())
+
+        finally:
+            if self._zip is not None:
+                self._zip.close()
+                self._zip = None
+
+            if self._tar is not None:
+                self._tar.close()
+                self._tar = None
+
+        os.replace(self._tmp, self.path)
+"""
+出力のバイト数が指定した上限に収まるよう、エンコードの設定をメモリ上で探すモジュール。
+"""
+
+
+# qualityを指定できる形式と、その範囲
+QUALITY_RANGES = {
+    "JPEG": (10, 95),
+    "WEBP": (10, 100),
+}
+
+# 縮小する際の倍率(%)の範囲
+SCALE_RANGE = (1, 99)
+
+
+class ByteBudget(NamedTuple):
+    max_bytes: int
+    allow_scale: bool = False
+    jobs: int = 1
+
+
+class ByteBudgetResult(NamedTuple):
+    data: Optional[bytes]
+    attempts: int
+    quality: Optional[int] = None
+    scale: int = 100
+
+
+def encode_image(image: Image.Image, image_format: str, quality: Optional[int] = None, scale: int = 100) -> bytes:
+    if scale != 100:
+        width, height = image.size
+        size = (max(1, width * scale // 100), max(1, height * scale // 100))
+        image = image.resize(size, Image.Resampling.LANCZOS)
+    else:
+        # saveは画像にencoderinfoを書き込むので、同時に試す時のためにコピーしてから使う
+        image = image.copy()
+
+    params = {}
+    if quality is not None:
+        params["quality"] = quality
+    if image_format == "PNG":
+        params["optimize"] = True
+
+    buf = io.BytesIO()
+    image.save(buf, format=image_format, **params)
+    return buf.getvalue()
+
+
+def search_largest_fit(
+        lo: int,
+        hi: int,
+        encode: Callable[[int], bytes],
+        max_bytes: int,
+        executor: Optional[Executor] = None,
+        jobs: int = 1) -> Tuple[Optional[Tuple[int, bytes]], int]:
+    best: Optional[Tuple[int, bytes]] = None
+    attempts = 0
+
+    while lo <= hi:
+        if executor is None or jobs <= 1:
+            candidates = [(lo + hi) // 2]
+        else:
+            candidates = sorted({lo + (hi - lo) * (i + 1) // (jobs + 1) for i in range(jobs)})
+
+        if executor is None:
+            results: List[bytes] = [encode(value) for value in candidates]
+        else:
+            results = list(executor.map(encode, candidates))
+        attempts += len(candidates)
+
+        new_lo, new_hi = lo, hi
+        for value, data in zip(candidates, results):
+            if len(data) > max_bytes:
+                # これより大きい値も収まらないとみなす
+                new_hi = value - 1
+                break
+
+            best = (value, data)
+            new_lo = value + 1
+
+        lo, hi = new_lo, new_hi
+
+    return best, attempts
+
+
+def fit_to_budget(image: Image.Image, image_format: str, budget: ByteBudget) -> ByteBudgetResult:
+    quality_range = QUALITY_RANGES.get(image_format)
+    image.load()
+
+    with ThreadPoolExecutor(max_workers=budget.jobs) if budget.jobs > 1 else nullcontext() as executor:
+        attempts = 0
+
+        def search(lo: int, hi: int, encode: Callable[[int], bytes]) -> Optional[Tuple[int, bytes]]:
+            nonlocal attempts
+            found, n = search_largest_fit(lo, hi, encode, budget.max_bytes, executor, budget.jobs)
+            attempts += n
+            return found
+
+        if quality_range is None:
+            data = encode_image(image, image_format)
+            attempts += 1
+            if len(data) <= budget.max_bytes:
+                return ByteBudgetResult(data, attempts)
+
+        else:
+            found = search(*quality_range, lambda quality: encode_image(image, image_format, quality))
+            if found is not None:
+                return ByteBudgetResult(found[1], attempts, quality=found[0])
+
+        if not budget.allow_scale:
+            return ByteBudgetResult(None, attempts)
+
+        min_quality = quality_range[0] if quality_range is not None else None
+        found = search(*SCALE_RANGE, lambda scale: encode_image(image, image_format, min_quality, scale))
+        if found is None:
+            return ByteBudgetResult(None, attempts)
+
+        scale, data = found
+        if quality_range is None:
+            return ByteBudgetResult(data, attempts, scale=scale)
+
+        # 最低のqualityでは収まることが分かっているので、それより上を探す
+        best = search(min_quality + 1, quality_range[1],
+                      lambda quality: encode_image(image, image_format, quality, scale))
+        if best is None:
+            return ByteBudgetResult(data, attempts, quality=min_quality, scale=scale)
+        return ByteBudgetResult(best[1], attempts, quality=best[0], scale=scale)
+
 
 
 
 def from_rgb(r: int, g: int, b: int) -> str:
-    """ RGBでターミナルで使える文字色を返す """
     return f"\033[38;2;{r};{g};{b}m"
 
 
 def bg_from_rgb(r: int, g: int, b: int) -> str:
-    """ RGBでターミナルで使える背景色を返す """
     return f"\033[48;2;{r};{g};{b}m"
 
 
 class Colors:
-    """色の名前空間
-
-    Reference
-        - https://www.nomuramath.com/kv8wr0mp/
-        - https://kaworu.jpn.org/kaworu/2018-05-19-1.php
-    """
     BLACK = '\033[30m'
     RED = '\033[31m'
     GREEN = '\033[32m'
@@ -56,9 +377,6 @@ class Colors:
 
 
 class ColorizedStreamFormatter(logging.Formatter):
-    """色を付けてログ出力するためのフォーマッター
-
-    """
 
     def __init__(self, fmt: Optional[str] = None, datefmt: Optional[str] = None, style="%") -> None:
         if fmt is not None:
@@ -82,9 +400,6 @@ class ColorizedStreamFormatter(logging.Formatter):
 
 
 class Logger(logging.Logger):
-    """CLI用のLogger
-
-    """
 
     def __init__(self, name: str, level: Union[str, int] = logging.INFO) -> None:
         super().__init__(name)
@@ -100,22 +415,44 @@ class Logger(logging.Logger):
 CLIのパーサー部分を記述したモジュール。
 """
 
+# バイト数の指定に使える単位
+BYTE_UNITS = {"K": 1024, "M": 1024 * 1024}
 
-class Args(NamedTuple):
-    """パーサーで取得した変数を補間するための、仮のタイプ定義。
 
-    """
+class Args(NamedTuple):
     inputs: List[str]
     output: str
     dpi: int
     crop: bool
     round: bool
     round_rate: int
+    strip_metadata: bool
+    icon_size: Optional[int]
+    icon_bit_depth: Optional[int]
+    max_bytes: Optional[int]
+    allow_scale: bool
+    max_bytes_jobs: int
+    timeout: Optional[float]
+    max_memory: Optional[int]
+    max_tasks_per_worker: int
+    retry_list: Optional[str]
+
+
+def parse_byte_size(value: str) -> int:
+    unit = BYTE_UNITS.get(value[-1:].upper(), 1)
+    number = value[:-1] if unit != 1 else value
+    try:
+        size = int(float(number) * unit)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(f"invalid byte size: {value}") from err
 
+    if size <= 0:
+        raise argparse.ArgumentTypeError(f"byte size must be positive: {value}")
+    return size
 
-def parse(*args, **kwargs) -> Args:
-    """ コマンドラインをパースした結果を返す """
-    parser = argparse.ArgumentParser()
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="imgconv", fromfile_prefix_chars="@")
 
     parser.add_argument("-i", "--inputs", required=True, nargs="+", help="pngなどの画像ファイル")
     parser.add_argument("-o", "--output", required=True,
@@ -126,9 +463,170 @@ def parse(*args, **kwargs) -> Args:
     parser.add_argument("--round", action="store_true", help="icoへ変換時、角丸にトリミングを行ってから処理をするか。")
     parser.add_argument("--round-rate", type=int, default=5, help="角丸にトリミングする際の、サイズに対する半径の比。大きいと半径は小さくなる。2でピッタリな円になる。")
 
-    namespace: Args = parser.parse_args(*args, **kwargs)        # type: ignore
+    parser.add_argument("--strip-metadata", action="store_true",
+                        help="Exifやテキストなどのメタデータを取り除く。入力と出力が同じ形式なら、画素を触らずに取り除く。")
+
+    parser.add_argument("--icon-size", type=int, default=None,
+                        help="exeからiconを取り出す際、指定したサイズ(px)のiconだけを取り出す。")
+    parser.add_argument("--icon-bit-depth", type=int, default=None,
+                        help="exeからiconを取り出す際、指定したビット深度のiconだけを取り出す。")
+
+    parser.add_argument("--max-bytes", type=parse_byte_size, default=None,
+                        help="出力のバイト数の上限。50K, 2Mのように単位を付けられる。qualityなどを探して上限に収める。")
+    parser.add_argument("--allow-scale", action="store_true", help="--max-bytesに収まらない場合に、画像の縮小も試すか。")
+    parser.add_argument("--max-bytes-jobs", type=int, default=1, help="--max-bytesの探索で、同時にエンコードを試す数。")
+
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="1ファイルあたりの変換時間の上限(秒)。指定すると変換は子プロセスで行われる。")
+    parser.add_argument("--max-memory", type=int, default=None,
+                        help="変換を行う子プロセスのメモリ上限(MB)。指定すると変換は子プロセスで行われる。")
+    parser.add_argument("--max-tasks-per-worker", type=int, default=100, help="子プロセスを作り直すまでに処理するファイル数。")
+    parser.add_argument("--retry-list", default=None,
+                        help="失敗したファイルを記録するファイル。`imgconv @retry-list`で再実行できる。指定すると変換は子プロセスで行われる。")
+
+    return parser
+
+
+def parse(*args, **kwargs) -> Args:
+    namespace: Args = build_parser().parse_args(*args, **kwargs)        # type: ignore
 
     return namespace
+
+
+def format_options(args: Args) -> List[str]:
+    parser = build_parser()
+    options: List[str] = []
+
+    for dest, value in vars(args).items():
+        if dest == "inputs" or value is None or value == parser.get_default(dest):
+            continue
+
+        flag = f"--{dest.replace('_', '-')}"
+        if isinstance(value, bool):
+            options.append(flag)
+        else:
+            options.extend([flag, str(value)])
+
+    return options
+"""
+入力の形式ごとに、変換を行うバックエンドを登録・選択するモジュール。
+"""
+
+
+def accept_any_output(_suffix: str) -> bool:
+    return True
+
+
+def accept_any_preprocessor(_preprocessor: Any) -> bool:
+    return True
+
+
+class ConverterBackend(NamedTuple):
+    name: str
+    input_formats: FrozenSet[str]
+    convert: Callable[..., Any]
+    can_output: Callable[[str], bool] = accept_any_output
+    cost: int = 0
+    can_preprocess: Callable[[Any], bool] = accept_any_preprocessor
+    convert_data: Optional[Callable[..., Any]] = None
+
+
+class ConverterRegistry:
+
+    def __init__(self) -> None:
+        self._backends: List[ConverterBackend] = []
+
+    def register(self, backend: ConverterBackend):
+        self._backends.append(backend)
+        self._backends.sort(key=lambda b: b.cost)
+
+    def find(
+            self,
+            input_format: str,
+            output_suffix: str,
+            preprocessor: Any = None,
+            in_memory: bool = False) -> Optional[ConverterBackend]:
+        for backend in self._backends:
+            if input_format not in backend.input_formats or not backend.can_output(output_suffix):
+                continue
+
+            if in_memory and backend.convert_data is None:
+                continue
+
+            if preprocessor is None or backend.can_preprocess(preprocessor):
+                return backend
+
+        return None
+
+    def supported_formats(self) -> Set[str]:
+        formats: Set[str] = set()
+        for backend in self._backends:
+            formats |= backend.input_formats
+        return formats
+"""
+ファイルの先頭の数バイトから、ファイルの形式を判別するモジュール。
+"""
+
+# 判別に読み込むバイト数
+HEAD_SIZE = 16
+
+# (形式名, ((オフセット, マジックナンバー), ...))
+# 形式名はpillowのformatを小文字にしたものに合わせる。
+SIGNATURES: List[Tuple[str, Tuple[Tuple[int, bytes], ...]]] = [
+    ("png", ((0, b"\x89PNG\r\n\x1a\n"),)),
+    ("jpeg", ((0, b"\xff\xd8\xff"),)),
+    ("gif", ((0, b"GIF87a"),)),
+    ("gif", ((0, b"GIF89a"),)),
+    ("pdf", ((0, b"%PDF-"),)),
+    ("pe", ((0, b"MZ"),)),
+    ("bmp", ((0, b"BM"),)),
+    ("ico", ((0, b"\x00\x00\x01\x00"),)),
+    ("cur", ((0, b"\x00\x00\x02\x00"),)),
+    ("icns", ((0, b"icns"),)),
+    ("eps", ((0, b"%!PS"),)),
+    ("eps", ((0, b"\xc5\xd0\xd3\xc6"),)),
+    ("tiff", ((0, b"II*\x00"),)),
+    ("tiff", ((0, b"MM\x00*"),)),
+    ("webp", ((0, b"RIFF"), (8, b"WEBP"))),
+    ("jpeg2000", ((0, b"\x00\x00\x00\x0cjP  \r\n\x87\n"),)),
+    ("jpeg2000", ((0, b"\xff\x4f\xff\x51"),)),
+    ("psd", ((0, b"8BPS"),)),
+    ("qoi", ((0, b"qoif"),)),
+    ("msp", ((0, b"DanM"),)),
+    ("msp", ((0, b"LinS"),)),
+    ("sgi", ((0, b"\x01\xda"),)),
+    ("im", ((0, b"Image type"),)),
+    ("xbm", ((0, b"#define"),)),
+]
+
+
+def sniff_format_from_bytes(head: bytes) -> Optional[str]:
+    for format_name, magics in SIGNATURES:
+        if all(head[offset:offset + len(magic)] == magic for offset, magic in magics):
+            return format_name
+
+    # P1~P6の後に空白が続くもの(PBM, PGM, PPM)
+    if len(head) >= 3 and head[:1] == b"P" and head[1:2] in b"123456" and head[2:3].isspace():
+        return "ppm"
+
+    # 0x0A, バージョン, エンコーディング(1: RLE)の順に並ぶもの
+    if len(head) >= 3 and head[0] == 0x0A and head[1] in (0, 2, 3, 4, 5) and head[2] == 1:
+        return "pcx"
+
+    return None
+
+
+def sniff_format(path: Path) -> Optional[str]:
+    if not path.is_file():
+        return None
+
+    try:
+        with open(path, "rb") as f:
+            head = f.read(HEAD_SIZE)
+    except OSError:
+        return None
+
+    return sniff_format_from_bytes(head)
 """
 Windows PE EXE icon extractor.
 TODO: resolve linting error
@@ -181,19 +679,21 @@ class InvalidIconDefinitionError(IconExtractorError):
     pass
 
 
-class IconExtractor():
-    """IconExtractor from exe file.
+class IconNotFoundError(IconExtractorError):
+    pass
 
-    This class is fully based on great repo https://github.com/jlu5/icoextract
 
-    """
+class IconExtractor():
 
-    def __init__(self, filename: str, logger: logging.Logger):
+    def __init__(self, filename: str, logger: logging.Logger, data: Optional[bytes] = None):
         self.filename = filename
         self.logger = logger
         # Use fast loading and explicitly load the RESOURCE directory entry. This saves a LOT of time
         # on larger files
-        self._pe = pefile.PE(filename, fast_load=True)
+        if data is None:
+            self._pe = pefile.PE(filename, fast_load=True)
+        else:
+            self._pe = pefile.PE(data=data, fast_load=True)
         self._pe.parse_data_directories(pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_RESOURCE'])
 
         if not hasattr(self._pe, 'DIRECTORY_ENTRY_RESOURCE'):
@@ -209,16 +709,10 @@ class IconExtractor():
         self.rticonres = resources.get(pefile.RESOURCE_TYPE["RT_ICON"])
 
     def list_group_icons(self):
-        """
-        Returns a list of group icon entries.
-        """
         return [(e.struct.Name, e.struct.OffsetToData)
                 for e in self.groupiconres.directory.entries]
 
     def _get_group_icon_entries(self, num=0):
-        """
-        Returns the group icon entries for the specified group icon in the executable.
-        """
         groupicon = self.groupiconres.directory.entries[num]
         if groupicon.struct.DataIsDirectory:
             # Select the first language from subfolders as needed.
@@ -250,9 +744,6 @@ class IconExtractor():
         return grp_icons
 
     def _get_icon_data(self, icon_ids):
-        """
-        Return a list of raw icon images corresponding to the icon IDs given.
-        """
         icons = []
         icon_entry_lists = {icon_entry_list.id: icon_entry_list for icon_entry_list in self.rticonres.directory.entries}
         for icon_id in icon_ids:
@@ -266,14 +757,8 @@ class IconExtractor():
             icons.append(data)
         return icons
 
-    def _write_ico(self, fd, num=0):
-        """
-        Writes ICO data to a file descriptor.
-        """
-        group_icons = self._get_group_icon_entries(num=num)
-        icon_images = self._get_icon_data([g.ID for g in group_icons])
-        icons = list(zip(group_icons, icon_images))
-        assert len(group_icons) == len(icon_images)
+    @staticmethod
+    def _write_ico_entries(fd, icons):
         fd.write(b"\x00\x00")  # 2 reserved bytes
         fd.write(struct.pack("<H", 1))  # 0x1 (little endian) specifying that this is an .ICO image
         fd.write(struct.pack("<H", len(icons)))  # number of images
@@ -285,8 +770,9 @@ class IconExtractor():
             # Elements in ICONDIRENTRY and GRPICONDIRENTRY are all the same
             # except the last value, which is an ID in GRPICONDIRENTRY and
             # the offset from the beginning of the file in ICONDIRENTRY.
-            fd.write(group_icon.__pack__()[:12])
-            fd.write(struct.pack("<I", dataoffset))
+            # The data size is taken from the actual data, since it may have been rewritten (e.g. stripped)
+            fd.write(group_icon.__pack__()[:8])
+            fd.write(struct.pack("<II", len(icon_data), dataoffset))
             dataoffset += len(icon_data)  # Increase offset for next image
 
         # Second pass: write the icon data
@@ -294,21 +780,455 @@ class IconExtractor():
             group_icon, icon_data = datapair
             fd.write(icon_data)
 
+    def _write_ico(self, fd, num=0):
+        group_icons = self._get_group_icon_entries(num=num)
+        icon_images = self._get_icon_data([g.ID for g in group_icons])
+        icons = list(zip(group_icons, icon_images))
+        assert len(group_icons) == len(icon_images)
+        self._write_ico_entries(fd, icons)
+
+    @staticmethod
+    def get_entry_size(entry):
+        return entry.Width or 256
+
+    def select_icon_entry(self, num=0, size=None, bit_depth=None):
+        entries = self._get_group_icon_entries(num=num)
+        available = ", ".join(f"{self.get_entry_size(e)}px/{e.BitCount}bit" for e in entries)
+
+        if bit_depth is not None:
+            entries = [e for e in entries if e.BitCount == bit_depth]
+        if size is not None:
+            entries = [e for e in entries if self.get_entry_size(e) == size]
+
+        if not entries:
+            raise IconNotFoundError(f"no icon of size={size}, bit_depth={bit_depth} (available: {available})")
+
+        return max(entries, key=lambda e: (self.get_entry_size(e), e.BitCount))
+
+    def get_icon_entry_data(self, num=0, size=None, bit_depth=None):
+        entry = self.select_icon_entry(num=num, size=size, bit_depth=bit_depth)
+        return entry, self._get_icon_data([entry.ID])[0]
+
+    def get_single_icon(self, entry, icon_data):
+        f = io.BytesIO()
+        self._write_ico_entries(f, [(entry, icon_data)])
+        f.seek(0)
+        return f
+
     def export_icon(self, fname, num=0):
-        """
-        Writes ICO data containing the program icon of the input executable.
-        """
         with open(fname, 'wb') as f:
             self._write_ico(f, num=num)
 
     def get_icon(self, num=0):
-        """
-        Returns ICO data as a BytesIO() instance, containing the program icon of the input executable.
-        """
         f = io.BytesIO()
         self._write_ico(f, num=num)
         return f
 """
+変換処理を子プロセスで実行し、ハングやクラッシュからバッチ全体を隔離するモジュール。
+"""
+
+try:
+    import resource
+except ImportError:
+    # Windowsにはresourceモジュールが無いため、メモリ制限は行えない
+    resource = None     # pylint: disable=invalid-name
+
+
+class TaskResult(NamedTuple):
+    ok: bool
+    reason: str
+    value: Any = None
+
+
+def _limit_memory(max_memory: Optional[int]):
+    if max_memory is None or resource is None:
+        return
+
+    limit = max_memory * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _worker_loop(conn: Connection, max_memory: Optional[int]):
+    if hasattr(os, "setsid"):
+        # popplerなどの孫プロセスもまとめて終了できるよう、新しいプロセスグループを作る
+        os.setsid()
+    _limit_memory(max_memory)
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+
+        if task is None:
+            break
+
+        func, args = task
+        try:
+            value = func(*args)
+        except MemoryError:
+            conn.send((False, "MemoryError: exceeded the memory limit", None))
+        except Exception as err:     # pylint: disable=broad-except
+            reason = f"{type(err).__name__}: {err}" if str(err) else type(err).__name__
+            conn.send((False, reason, None))
+        else:
+            conn.send((True, "", value))
+
+    conn.close()
+
+
+class IsolatedWorker:
+
+    def __init__(
+            self,
+            logger: logging.Logger,
+            *,
+            timeout: Optional[float] = None,
+            max_memory: Optional[int] = None,
+            max_tasks: int = 100) -> None:
+        self.logger = logger
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.max_tasks = max_tasks
+
+        if max_memory is not None and resource is None:
+            self.logger.warning("--max-memory is not supported on this platform, so it will be ignored.")
+
+        self._process: Optional[multiprocessing.Process] = None
+        self._conn: Optional[Connection] = None
+        self._done_tasks = 0
+
+    def __enter__(self) -> "IsolatedWorker":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _start(self):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_worker_loop, args=(child_conn, self.max_memory), daemon=True)
+        self._process.start()
+        child_conn.close()
+
+        self._conn = parent_conn
+        self._done_tasks = 0
+        self.logger.debug(f"started a worker process (pid: {self._process.pid})")
+
+    def _stop(self, force: bool = False):
+        if self._process is None or self._conn is None:
+            return
+
+        if not force and self._process.is_alive():
+            try:
+                self._conn.send(None)
+            except OSError:
+                pass
+            self._process.join(timeout=5)
+
+        if force or self._process.is_alive():
+            self._kill_process_group()
+        self._process.join()
+        self._conn.close()
+
+        self.logger.debug(f"stopped a worker process (pid: {self._process.pid})")
+        self._process = None
+        self._conn = None
+
+    def _kill_process_group(self):
+        assert self._process is not None
+
+        if hasattr(os, "killpg") and self._process.pid is not None:
+            try:
+                os.killpg(self._process.pid, signal.SIGKILL)
+                return
+            except OSError:
+                # setsidの前に終了させる時は、まだプロセスグループが無い
+                pass
+
+        if self._process.is_alive():
+            self._process.terminate()
+
+    def call(self, func: Callable[..., Any], *args: Any) -> TaskResult:
+        if self._process is None:
+            self._start()
+        assert self._process is not None and self._conn is not None
+
+        self._conn.send((func, args))
+
+        if not self._conn.poll(self.timeout):
+            self._stop(force=True)
+            return TaskResult(False, f"timed out after {self.timeout} seconds")
+
+        try:
+            ok, reason, value = self._conn.recv()
+        except EOFError:
+            self._process.join()
+            exitcode = self._process.exitcode
+            self._stop(force=True)
+            return TaskResult(False, f"the worker process crashed (exit code: {exitcode})")
+
+        self._done_tasks += 1
+        if not ok or self._done_tasks >= self.max_tasks:
+            self._stop()
+
+        return TaskResult(ok, reason, value)
+
+    def close(self):
+        self._stop()
+"""
+画素を触らずに、バイト列のまま画像をコピー・加工するモジュール。
+"""
+
+try:
+    import fcntl
+except ImportError:
+    # Windowsにはfcntlモジュールが無いため、reflinkは使えない
+    fcntl = None     # pylint: disable=invalid-name
+
+# linux/fs.hで定義されているioctlの番号
+FICLONE = 0x40049409
+
+BLOCK_SIZE = 1024 * 1024
+
+# 出力の拡張子と、同じコンテナとみなす形式名の対応
+PASSTHROUGH_SUFFIXES: Dict[str, str] = {
+    ".bmp": "bmp",
+    ".gif": "gif",
+    ".icns": "icns",
+    ".ico": "ico",
+    ".jfif": "jpeg",
+    ".jpe": "jpeg",
+    ".jpeg": "jpeg",
+    ".jpg": "jpeg",
+    ".pdf": "pdf",
+    ".png": "png",
+    ".tif": "tiff",
+    ".tiff": "tiff",
+    ".webp": "webp",
+}
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# 表示に影響しないチャンク. 色やαに関わるチャンク(iCCP, gAMA, tRNSなど)は残す
+# eXIfは向き(Orientation)に関わるので、Orientationだけを残したものに置き換える
+PNG_METADATA_CHUNKS = {b"tEXt", b"zTXt", b"iTXt", b"eXIf", b"tIME"}
+PNG_EXIF_CHUNK = b"eXIf"
+
+# APP1(Exif, XMP), APP13(IPTC), COM. ICCプロファイル(APP2)やAdobe(APP14)は色に関わるので残す
+# Exifは向き(Orientation)に関わるので、Orientationだけを残したものに置き換える
+JPEG_METADATA_MARKERS = {0xE1, 0xED, 0xFE}
+JPEG_APP1 = 0xE1
+JPEG_EXIF_HEADER = b"Exif\x00\x00"
+# 長さを持たないマーカー. TEM, RST0~7
+JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}
+JPEG_SOS = 0xDA
+JPEG_EOI = 0xD9
+
+EXIF_ORIENTATION = 0x0112
+EXIF_TYPE_SHORT = 3
+
+
+def is_same_container(input_format: str, suffix: str) -> bool:
+    return PASSTHROUGH_SUFFIXES.get(suffix.lower()) == input_format
+
+
+def is_same_file(src: Path, dst: Path) -> bool:
+    return dst.exists() and os.path.samefile(src, dst)
+
+
+def _copy_bytes(fsrc: BinaryIO, fdst: BinaryIO, size: int):
+    while size > 0:
+        buf = fsrc.read(min(size, BLOCK_SIZE))
+        if not buf:
+            raise ValueError("unexpected end of file")
+        fdst.write(buf)
+        size -= len(buf)
+
+
+def _read_exact(fsrc: BinaryIO, size: int, file_format: str) -> bytes:
+    buf = fsrc.read(size)
+    if len(buf) != size:
+        raise ValueError(f"truncated {file_format}")
+    return buf
+
+
+def _try_reflink(fsrc: BinaryIO, fdst: BinaryIO) -> bool:
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        return False
+
+    return True
+
+
+def _try_copy_file_range(fsrc: BinaryIO, fdst: BinaryIO) -> bool:
+    if not hasattr(os, "copy_file_range"):
+        return False
+
+    copied = 0
+    while True:
+        try:
+            n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), BLOCK_SIZE * 64)
+        except OSError:
+            if copied == 0:
+                return False
+            raise
+
+        if n == 0:
+            return True
+        copied += n
+
+
+def copy_file(src: Path, dst: Path):
+    if is_same_file(src, dst):
+        return
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if _try_reflink(fsrc, fdst) or _try_copy_file_range(fsrc, fdst):
+            return
+        shutil.copyfileobj(fsrc, fdst, BLOCK_SIZE)
+
+
+def _read_exif_orientation(tiff: bytes) -> Optional[int]:
+    if tiff[:4] == b"II*\x00":
+        endian = "<"
+    elif tiff[:4] == b"MM\x00*":
+        endian = ">"
+    else:
+        return None
+
+    try:
+        (offset,) = struct.unpack_from(f"{endian}I", tiff, 4)
+        (count,) = struct.unpack_from(f"{endian}H", tiff, offset)
+        for i in range(count):
+            tag, value_type, _, value = struct.unpack_from(f"{endian}HHI4s", tiff, offset + 2 + i * 12)
+            if tag == EXIF_ORIENTATION and value_type == EXIF_TYPE_SHORT:
+                return struct.unpack_from(f"{endian}H", value)[0]
+    except struct.error:
+        return None
+
+    return None
+
+
+def _build_orientation_exif(orientation: int) -> bytes:
+    # ヘッダ, IFD0のエントリ数, Orientationのエントリ(SHORTが1つ), 次のIFDのオフセット
+    return b"MM\x00*" + struct.pack(">IHHHIHHI", 8, 1, EXIF_ORIENTATION, EXIF_TYPE_SHORT, 1, orientation, 0, 0)
+
+
+def _minimize_exif(tiff: bytes) -> Optional[bytes]:
+    orientation = _read_exif_orientation(tiff)
+    if orientation is None or orientation == 1:
+        return None
+
+    return _build_orientation_exif(orientation)
+
+
+def _strip_png_metadata(fsrc: BinaryIO, fdst: BinaryIO):
+    signature = fsrc.read(len(PNG_SIGNATURE))
+    if signature != PNG_SIGNATURE:
+        raise ValueError("not a PNG file")
+    fdst.write(signature)
+
+    while True:
+        # IENDより前にファイルが終わっている場合も、途中で切れたものとして扱う
+        header = _read_exact(fsrc, 8, "PNG")
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == PNG_EXIF_CHUNK:
+            exif = _minimize_exif(_read_exact(fsrc, length, "PNG"))
+            _read_exact(fsrc, 4, "PNG")
+            if exif is not None:
+                fdst.write(struct.pack(">I4s", len(exif), chunk_type))
+                fdst.write(exif)
+                fdst.write(struct.pack(">I", zlib.crc32(chunk_type + exif)))
+            continue
+
+        if chunk_type in PNG_METADATA_CHUNKS:
+            # データとCRCを読み飛ばす
+            fsrc.seek(length + 4, os.SEEK_CUR)
+            continue
+
+        fdst.write(header)
+        _copy_bytes(fsrc, fdst, length + 4)
+        if chunk_type == b"IEND":
+            break
+
+
+def _strip_jpeg_metadata(fsrc: BinaryIO, fdst: BinaryIO):
+    soi = fsrc.read(2)
+    if soi != b"\xff\xd8":
+        raise ValueError("not a JPEG file")
+    fdst.write(soi)
+
+    while True:
+        marker = _read_exact(fsrc, 2, "JPEG")
+        if marker[0] != 0xFF:
+            fdst.write(marker)
+            break
+
+        code = marker[1]
+        if code in (JPEG_SOS, JPEG_EOI):
+            # 以降は画像データなので、そのままコピーする
+            fdst.write(marker)
+            break
+
+        if code in JPEG_STANDALONE_MARKERS:
+            fdst.write(marker)
+            continue
+
+        length_bytes = _read_exact(fsrc, 2, "JPEG")
+        (length,) = struct.unpack(">H", length_bytes)
+        if length < 2:
+            raise ValueError("invalid JPEG segment length")
+
+        if code == JPEG_APP1:
+            segment = _read_exact(fsrc, length - 2, "JPEG")
+            if segment.startswith(JPEG_EXIF_HEADER):
+                exif = _minimize_exif(segment[len(JPEG_EXIF_HEADER):])
+                if exif is not None:
+                    fdst.write(marker + struct.pack(">H", len(JPEG_EXIF_HEADER) + len(exif) + 2))
+                    fdst.write(JPEG_EXIF_HEADER + exif)
+            continue
+
+        if code in JPEG_METADATA_MARKERS:
+            fsrc.seek(length - 2, os.SEEK_CUR)
+            continue
+
+        fdst.write(marker + length_bytes)
+        _copy_bytes(fsrc, fdst, length - 2)
+
+    shutil.copyfileobj(fsrc, fdst, BLOCK_SIZE)
+
+
+METADATA_STRIPPERS: Dict[str, Callable[[BinaryIO, BinaryIO], None]] = {
+    "png": _strip_png_metadata,
+    "jpeg": _strip_jpeg_metadata,
+}
+
+
+def can_strip_metadata(input_format: str) -> bool:
+    return input_format in METADATA_STRIPPERS
+
+
+def strip_metadata(src: Path, dst: Path, input_format: str):
+    tmp = dst.with_name(f".{dst.name}.tmp")
+    try:
+        with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+            METADATA_STRIPPERS[input_format](fsrc, fdst)
+        os.replace(tmp, dst)
+
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def strip_metadata_from_bytes(data: bytes, input_format: str) -> bytes:
+    fdst = io.BytesIO()
+    METADATA_STRIPPERS[input_format](io.BytesIO(data), fdst)
+    return fdst.getvalue()
+"""
 CLI本体を定義する。
 """
 
@@ -318,29 +1238,34 @@ logger = Logger("imgconv")
 
 POPPLER_PATH = Path(__file__).parent.parent.absolute() / "poppler/bin"
 
+# アルファチャンネルを保存できない、pillowの形式名
+FORMATS_WITHOUT_ALPHA = {"EPS", "JPEG", "PCX", "PDF", "PPM"}
 
-class Preprocessor:
-    """前処理を行うクラス
+# メモリ上で変換した結果. (ページ名, データ)のリストで、ページ名がNoneなら出力名そのままに書き出す
+ConvertedData = List[Tuple[Optional[str], bytes]]
 
-    """
 
-    def __init__(self, *, do_crop_center: bool = False, do_round: bool = False, round_rate: int = 5) -> None:
+class Preprocessor:
+
+    def __init__(
+            self,
+            *,
+            do_crop_center: bool = False,
+            do_round: bool = False,
+            round_rate: int = 5,
+            strip_metadata: bool = False,
+            byte_budget: Optional[ByteBudget] = None) -> None:
         self.do_crop_center = do_crop_center
         self.do_round = do_round
         self.round_rate = round_rate
+        self.strip_metadata = strip_metadata
+        self.byte_budget = byte_budget
 
-    def preprocess(self, image_path: Path) -> Image.Image:
-        """前処理を行った画像を返す
-
-        Args:
-            image_path (Path): 入力画像のパル
+    @property
+    def needs_pixel_work(self) -> bool:
+        return self.do_crop_center or self.do_round
 
-        Raises:
-            UnidentifiedImageError: openに失敗した時
-
-        Returns:
-            Image.Image: 前処理された画像
-        """
+    def preprocess(self, image_path: Path) -> Image.Image:
         try:
             image = Image.open(image_path)
 
@@ -349,6 +1274,9 @@ class Preprocessor:
             logger.exception(err)
             raise UnidentifiedImageError from err
 
+        return self.process(image)
+
+    def process(self, image: Image.Image) -> Image.Image:
         if self.do_crop_center:
             image = self.crop_max_square(image)
 
@@ -359,19 +1287,6 @@ class Preprocessor:
         return image
 
     def crop_center(self, image: Image.Image, crop_width: int, crop_height: int) -> Image.Image:
-        """画像の中心から指定したサイズで切り出す
-
-        Args:
-            image (Image.Image): 入力画像
-            crop_width (int): 切り出す幅
-            crop_height (int): 切り出す高さ
-
-        Returns:
-            Image.Image: 指定したサイズで中心から切り抜いた画像
-
-        Note:
-            - [Python, Pillowで画像の一部をトリミング（切り出し/切り抜き）](https://note.nkmk.me/python-pillow-image-crop-trimming/)
-        """
         img_width, img_height = image.size
         return image.crop((
             (img_width - crop_width) // 2,
@@ -381,35 +1296,12 @@ class Preprocessor:
         ))
 
     def crop_max_square(self, image: Image.Image) -> Image.Image:
-        """画像からできるだけ大きな正方形を中心から切り出す
-
-        Args:
-            image (Image.Image): 入力画像
-
-        Returns:
-            Image.Image: 正方形の画像。
-
-        Note:
-            - [Python, Pillowで正方形・円形のサムネイル画像を一括作成](https://note.nkmk.me/python-pillow-square-circle-thumbnail/)
-        """
         if image.size[0] == image.size[1]:
             return image
         else:
             return self.crop_center(image, min(image.size), min(image.size))
 
     def get_round_mask(self, image: Image.Image, r: int = 100) -> Image.Image:
-        """角丸四角のマスクを生成して返す
-
-        Args:
-            image (Image.Image): 入力画像
-            r (int, optional): 角丸部分の半径. Defaults to 100.
-
-        Returns:
-            Image.Image: マスク
-
-        Note:
-            - [Pillowを使用して角丸四角を描画する](http://kyle-in-jp.blogspot.com/2019/06/pillow.html?m=1)
-        """
         mask = Image.new("L", image.size, 0)
         draw = ImageDraw.Draw(mask)
 
@@ -431,16 +1323,6 @@ class Preprocessor:
             image: Image.Image,
             radius: int = 100,
             use_filter: bool = True) -> Image.Image:
-        """丸四角でトリミングされた画像を返す
-
-        Args:
-            image (Image.Image): 入力画像
-            radius (int, optional): 各丸の半径. Defaults to 100.
-            use_filter (bool, optional): フィルタをかけるかどうか. Defaults to True.
-
-        Returns:
-            Image.Image: 各丸四角でトリミングされた画像
-        """
         mask = self.get_round_mask(image, radius)
         if use_filter:
             mask = mask.filter(ImageFilter.SMOOTH)
@@ -450,36 +1332,71 @@ class Preprocessor:
         return result
 
 
-def convert_by_pillow(image: Image.Image, img_output: Path):
-    """pillowを用いて画像を変換する
+class ByteBudgetError(ValueError):
+    pass
 
-    Args:
-        img_input (Image.Image): 入力画像
-        img_output (Path): 出力画像名
-    """
-    try:
+
+def save_to_bytes(image: Image.Image, suffix: str, byte_budget: Optional[ByteBudget] = None) -> bytes:
+    image_format = Image.registered_extensions()[suffix.lower()]
+    if byte_budget is None:
+        buf = io.BytesIO()
+        image.save(buf, format=image_format)
+        return buf.getvalue()
+
+    result = fit_to_budget(image, image_format, byte_budget)
+    if result.data is None:
+        raise ByteBudgetError(f"could not fit the image into {byte_budget.max_bytes} bytes "
+                              f"after {result.attempts} attempts")
+
+    logger.info(f"fitted the image into {len(result.data)} bytes after {result.attempts} attempts "
+                f"(quality: {result.quality}, scale: {result.scale}%)")
+    return result.data
+
+
+def flatten_alpha(image: Image.Image, suffix: str) -> Image.Image:
+    if Image.registered_extensions().get(suffix.lower()) not in FORMATS_WITHOUT_ALPHA:
+        return image
+
+    if image.mode not in ("RGBA", "LA", "PA") and not (image.mode == "P" and "transparency" in image.info):
+        return image
+
+    rgba = image.convert("RGBA")
+    background = Image.new("RGB", rgba.size, "white")
+    background.paste(rgba, mask=rgba.getchannel("A"))
+    return background
+
+
+def save_image(image: Image.Image, img_output: Path, byte_budget: Optional[ByteBudget] = None):
+    if byte_budget is None:
         image.save(img_output)
 
+    else:
+        img_output.write_bytes(save_to_bytes(image, img_output.suffix, byte_budget))
+
+
+def convert_by_pillow(image: Image.Image, img_output: Path, byte_budget: Optional[ByteBudget] = None) -> bool:
+    try:
+        save_image(image, img_output, byte_budget)
+
+    except ByteBudgetError as err:
+        # 上限に収まらないのは想定された結果なので、トレースバックは出さない
+        logger.error(f"failed to convert into {img_output}: {err}")
+        return False
+
     except (ValueError, OSError) as err:
         logger.error("failed to convert!")
         logger.exception(err)
+        return False
 
+    return True
 
-def convert_pdf(img_input: Path, img_output: Path, options: Dict[str, Any]) -> List[Image.Image]:
-    """PDFを入力画像として変換する
-
-    Args:
-        img_input (Path): 入力画像
-        img_output (Path): 出力画像パス
-        options (Dict[str, Any]): options for pdf2image.convert_from_path
 
-    Returns:
-        List[Image.Image]: images converted from pdf
-    """
+def convert_pdf(img_input: Path, img_output: Path, options: Dict[str, Any],
+                byte_budget: Optional[ByteBudget] = None) -> List[Image.Image]:
     pages: List[Image.Image] = pdf2image.convert_from_path(
         img_input, **options, poppler_path=POPPLER_PATH)
     if len(pages) == 1:
-        pages[0].save(img_output)
+        save_image(pages[0], img_output, byte_budget)
 
     else:
         out_folder = img_output.with_name(img_output.stem)
@@ -488,89 +1405,95 @@ def convert_pdf(img_input: Path, img_output: Path, options: Dict[str, Any]) -> L
         out_folder.mkdir(exist_ok=True)
 
         for i, page in enumerate(pages):
-            page.save(out_folder / f"{i}{fmt_out}")
+            save_image(page, out_folder / f"{i}{fmt_out}", byte_budget)
 
     return pages
 
 
-def convert(img_input: Path, img_output: Path, preprocessor: Preprocessor, pdf2image_options: Dict[str, Any]):
-    """画像・PDFを変換する
-
-    Args:
-        img_input (Path): 入力画像
-        img_output (Path): 出力画像パス
-        preprocessor (Preprocessor): 前処理用インスタンス
-        pdf2image_options (Dict[str, Any]): pdf2imageに渡すオプション
-    """
-    input_format = img_input.suffix
-    # output_format = img_output.suffix
-
-    pillow_permit_extensions = [
-        ".bmp",
-        ".eps",
-        ".gif",
-        ".icns",
-        ".ico",
-        ".im",
-        ".jpeg",
-        ".jfif",
-        ".jpg",
-        ".msp",
-        ".pcx",
-        ".png",
-        ".sgi",
-        ".xbm"
-    ]
-
-    if input_format == ".pdf":
-        convert_pdf(img_input, img_output, pdf2image_options)
-
-    elif input_format in pillow_permit_extensions:
-        image = preprocessor.preprocess(img_input)
-        convert_by_pillow(image, img_output)
-
-    else:
-        logger.error(f"The extension {input_format} is not permitted now...")
-
-    logger.info(f"successfully converted {img_input} into {img_output}")
-
-
-def extract_icon(img_input: Path, img_output: Path, num: int = 0):
-    """exeからiconを取り出す
-
-    Args:
-        img_input (Path): 入力ファイル(.exe)
-        img_output (Path): 出力ファイル名(.ico)
-        num (int, optional): 何番目のiconを出力するか. Defaults to 0.
-    """
-    if img_output.suffix != ".ico":
-        logger.error(f"IconExtractor do not support {img_output.suffix} now...")
-        logger.warning(f"failed to extract {img_input} into {img_output}.")
-        return
-
+def export_icon_data(
+        extractor: IconExtractor,
+        suffix: str,
+        num: int = 0,
+        *,
+        preprocessor: Optional[Preprocessor] = None,
+        size: Optional[int] = None,
+        bit_depth: Optional[int] = None) -> bytes:
+    needs_pixel_work = preprocessor is not None and preprocessor.needs_pixel_work
+    strips_metadata = preprocessor is not None and preprocessor.strip_metadata
+    byte_budget = preprocessor.byte_budget if preprocessor is not None else None
+    suffix = suffix.lower()
+
+    if suffix == ".ico" and size is None and bit_depth is None and not needs_pixel_work and byte_budget is None:
+        if strips_metadata:
+            logger.warning(f"the icon group of {extractor.filename} is copied as it is, so its metadata is kept. "
+                           "specify --icon-size or --icon-bit-depth to strip it from a single icon.")
+        return extractor.get_icon(num).getvalue()
+
+    entry, icon_data = extractor.get_icon_entry_data(num, size=size, bit_depth=bit_depth)
+    is_png = icon_data.startswith(b"\x89PNG")
+    logger.debug(f"selected the icon of {extractor.get_entry_size(entry)}px/{entry.BitCount}bit "
+                 f"({'PNG' if is_png else 'DIB'})")
+
+    if not needs_pixel_work and byte_budget is None:
+        if is_png and strips_metadata:
+            # PNGで埋め込まれているiconは、再エンコードせずにメタデータだけを取り除く
+            icon_data = strip_metadata_from_bytes(icon_data, "png")
+
+        if suffix == ".ico":
+            # pillowで保存すると複数のサイズが作られてしまうので、選んだiconだけをicoにまとめる
+            return extractor.get_single_icon(entry, icon_data).getvalue()
+
+        if is_png and suffix == ".png":
+            # PNGで埋め込まれているiconは、そのまま書き出す
+            return icon_data
+
+    # DIBのiconは、1つだけを含むicoとしてpillowで開く
+    stream = io.BytesIO(icon_data) if is_png else extractor.get_single_icon(entry, icon_data)
+    image = Image.open(stream)
+    if preprocessor is not None:
+        image = preprocessor.process(image)
+    # iconはRGBAなので、jpegなどへ出力する時は背景に重ねる
+    image = flatten_alpha(image, suffix)
+    return save_to_bytes(image, suffix, byte_budget)
+
+
+def extract_icon(
+        img_input: Path,
+        img_output: Path,
+        num: int = 0,
+        *,
+        preprocessor: Optional[Preprocessor] = None,
+        size: Optional[int] = None,
+        bit_depth: Optional[int] = None) -> bool:
     try:
-        IconExtractor(str(img_input), logger).export_icon(img_output, num)
+        extractor = IconExtractor(str(img_input), logger)
+        data = export_icon_data(extractor, img_output.suffix, num,
+                                preprocessor=preprocessor, size=size, bit_depth=bit_depth)
+        img_output.write_bytes(data)
+
     except IconExtractorError as err:
         logger.error(f"during extracting {img_input} into {img_output}, encountered an error: {err}")
         logger.warning("failed to extract.")
+    except ByteBudgetError as err:
+        logger.error(f"failed to convert into {img_output}: {err}")
+    except (ValueError, OSError) as err:
+        logger.error("failed to convert!")
+        logger.exception(err)
     else:
         logger.info(f"successfully extract {img_input} into {img_output}")
+        return True
 
+    return False
 
-def resolve_output_file_path(img_input: Path, out: str) -> Path:
-    """outの形式に応じて、出力先のパスを返す
 
-    Args:
-        img_input (Path): 入力画像
-        out (str): 出力先の情報(ファイルorディレクトリ), ${name}などを含む可能性がある。
-
-    Returns:
-        Path: 出力画像のパス
-    """
+def substitute_output_variables(img_input: PurePath, out: str) -> str:
     out = out.replace("${stem}", img_input.stem)
     out = out.replace("${dir}", str(img_input.parent))
+    return out
+
 
-    img_output = Path(out)
+def resolve_output_file_path(img_input: PurePath, out: str) -> Path:
+    img_output = Path(substitute_output_variables(img_input, out))
 
     if img_output.is_dir():
         raise ValueError("format of the output name is invalid.")
@@ -578,8 +1501,11 @@ def resolve_output_file_path(img_input: Path, out: str) -> Path:
     return img_output
 
 
+def resolve_member_name(img_input: PurePath, pattern: str) -> PurePosixPath:
+    return PurePosixPath(substitute_output_variables(PurePosixPath(img_input.as_posix()), pattern))
+
+
 def get_img_inputs_from_user_inputs(inputs: List[str]):
-    """ 入力されたファイルを順にイテレーションする """
     for pattern in inputs:
         logger.debug(pattern)
         if Path(pattern).is_absolute():
@@ -590,23 +1516,315 @@ def get_img_inputs_from_user_inputs(inputs: List[str]):
                 yield img_input
 
 
+def can_save_by_pillow(suffix: str) -> bool:
+    image_format = Image.registered_extensions().get(suffix.lower())
+    return image_format is not None and image_format in Image.SAVE
+
+
+def convert_image_by_pillow(img_input: Path, img_output: Path, preprocessor: Preprocessor,
+                            _pdf2image_options: Dict[str, Any], _icon_options: Dict[str, Any]) -> bool:
+    image = preprocessor.preprocess(img_input)
+    if not convert_by_pillow(image, img_output, preprocessor.byte_budget):
+        return False
+
+    logger.info(f"successfully converted {img_input} into {img_output}")
+    return True
+
+
+def convert_pdf_by_pdf2image(img_input: Path, img_output: Path, preprocessor: Preprocessor,
+                             pdf2image_options: Dict[str, Any], _icon_options: Dict[str, Any]) -> bool:
+    try:
+        convert_pdf(img_input, img_output, pdf2image_options, preprocessor.byte_budget)
+
+    except ByteBudgetError as err:
+        logger.error(f"failed to convert {img_input}: {err}")
+        return False
+
+    logger.info(f"successfully converted {img_input} into {img_output}")
+    return True
+
+
+def extract_icon_from_pe(img_input: Path, img_output: Path, preprocessor: Preprocessor,
+                         _pdf2image_options: Dict[str, Any], icon_options: Dict[str, Any]) -> bool:
+    return extract_icon(img_input, img_output, preprocessor=preprocessor, **icon_options)
+
+
+def convert_image_data(data: bytes, output_suffix: str, preprocessor: Preprocessor,
+                       _pdf2image_options: Dict[str, Any], _icon_options: Dict[str, Any]) -> ConvertedData:
+    image = preprocessor.process(Image.open(io.BytesIO(data)))
+    return [(None, save_to_bytes(image, output_suffix, preprocessor.byte_budget))]
+
+
+def convert_pdf_data(data: bytes, output_suffix: str, preprocessor: Preprocessor,
+                     pdf2image_options: Dict[str, Any], _icon_options: Dict[str, Any]) -> ConvertedData:
+    pages: List[Image.Image] = pdf2image.convert_from_bytes(data, **pdf2image_options, poppler_path=POPPLER_PATH)
+    if len(pages) == 1:
+        return [(None, save_to_bytes(pages[0], output_suffix, preprocessor.byte_budget))]
+
+    return [(str(i), save_to_bytes(page, output_suffix, preprocessor.byte_budget)) for i, page in enumerate(pages)]
+
+
+def extract_icon_data(data: bytes, output_suffix: str, preprocessor: Preprocessor,
+                      _pdf2image_options: Dict[str, Any], icon_options: Dict[str, Any]) -> ConvertedData:
+    extractor = IconExtractor("<memory>", logger, data=data)
+    return [(None, export_icon_data(extractor, output_suffix, preprocessor=preprocessor, **icon_options))]
+
+
+def passthrough(input_format: str, img_input: Path, img_output: Path, preprocessor: Preprocessor,
+                _pdf2image_options: Dict[str, Any], _icon_options: Dict[str, Any]) -> bool:
+    try:
+        if preprocessor.strip_metadata and can_strip_metadata(input_format):
+            strip_metadata(img_input, img_output, input_format)
+
+        else:
+            warn_unstrippable_metadata(input_format, preprocessor, str(img_input))
+            copy_file(img_input, img_output)
+
+    except (ValueError, OSError) as err:
+        logger.error("failed to convert!")
+        logger.exception(err)
+        return False
+
+    logger.info(f"successfully copied {img_input} into {img_output} without decoding")
+    return True
+
+
+def passthrough_data(input_format: str, data: bytes, _output_suffix: str, preprocessor: Preprocessor,
+                     _pdf2image_options: Dict[str, Any], _icon_options: Dict[str, Any]) -> ConvertedData:
+    if preprocessor.strip_metadata and can_strip_metadata(input_format):
+        data = strip_metadata_from_bytes(data, input_format)
+
+    else:
+        warn_unstrippable_metadata(input_format, preprocessor, "the input")
+
+    return [(None, data)]
+
+
+def warn_unstrippable_metadata(input_format: str, preprocessor: Preprocessor, name: str):
+    if preprocessor.strip_metadata:
+        logger.warning(f"metadata of {input_format} cannot be stripped without re-encoding, "
+                       f"so {name} is copied as it is.")
+
+
+def can_passthrough(preprocessor: Preprocessor) -> bool:
+    return not preprocessor.needs_pixel_work and preprocessor.byte_budget is None
+
+
+def register_passthrough_backends(registry: ConverterRegistry):
+    for input_format in sorted(set(PASSTHROUGH_SUFFIXES.values())):
+        registry.register(ConverterBackend(
+            "passthrough",
+            frozenset({input_format}),
+            partial(passthrough, input_format),
+            partial(is_same_container, input_format),
+            cost=0,
+            can_preprocess=can_passthrough,
+            convert_data=partial(passthrough_data, input_format)))
+
+
+CONVERTERS = ConverterRegistry()
+register_passthrough_backends(CONVERTERS)
+CONVERTERS.register(ConverterBackend(
+    "pillow",
+    # requirements.txtで固定しているpillow 9.3で開ける形式. QOIの読み込みは9.5からなので含めない
+    frozenset({"bmp", "cur", "eps", "gif", "icns", "ico", "im", "jpeg", "jpeg2000", "msp", "pcx", "png", "ppm", "psd",
+               "sgi", "tiff", "webp", "xbm"}),
+    convert_image_by_pillow,
+    can_save_by_pillow,
+    cost=10,
+    convert_data=convert_image_data))
+CONVERTERS.register(ConverterBackend("pdf2image", frozenset({"pdf"}), convert_pdf_by_pdf2image, can_save_by_pillow,
+                                     cost=20, convert_data=convert_pdf_data))
+CONVERTERS.register(ConverterBackend("iconextractor", frozenset({"pe"}), extract_icon_from_pe, can_save_by_pillow,
+                                     cost=10, convert_data=extract_icon_data))
+
+
+def convert(img_input: Path, img_output: Path, preprocessor: Preprocessor, pdf2image_options: Dict[str, Any],
+            icon_options: Dict[str, Any]) -> bool:
+    input_format = sniff_format(img_input)
+    if input_format is None:
+        logger.error(f"could not identify the format of {img_input}, so it is skipped.")
+        return False
+
+    backend = CONVERTERS.find(input_format, img_output.suffix, preprocessor)
+    if backend is None:
+        logger.error(f"The conversion from {input_format} ({img_input}) into {img_output.suffix} "
+                     "is not permitted now...")
+        return False
+
+    logger.debug(f"{img_input} is identified as {input_format}, and converted by {backend.name}")
+    return backend.convert(img_input, img_output, preprocessor, pdf2image_options, icon_options)
+
+
+def convert_data(data: bytes, name: str, output_suffix: str, preprocessor: Preprocessor,
+                 pdf2image_options: Dict[str, Any], icon_options: Dict[str, Any]) -> Optional[ConvertedData]:
+    input_format = sniff_format_from_bytes(data[:HEAD_SIZE])
+    if input_format is None:
+        logger.error(f"could not identify the format of {name}, so it is skipped.")
+        return None
+
+    backend = CONVERTERS.find(input_format, output_suffix, preprocessor, in_memory=True)
+    if backend is None or backend.convert_data is None:
+        logger.error(f"The conversion from {input_format} ({name}) into {output_suffix} is not permitted now...")
+        return None
+
+    logger.debug(f"{name} is identified as {input_format}, and converted by {backend.name} in memory")
+    try:
+        return backend.convert_data(data, output_suffix, preprocessor, pdf2image_options, icon_options)
+
+    except (UnidentifiedImageError, ValueError, OSError, IconExtractorError) as err:
+        logger.error(f"failed to convert {name}: {err}")
+        return None
+
+
+def write_outputs(outputs: ConvertedData, name: str, img_output: PurePath,
+                  writer: Optional[ArchiveWriter]):
+    for page, data in outputs:
+        # 複数ページの場合は、convert_pdfと同じく拡張子を除いたフォルダにページ番号で書き出す
+        output = img_output if page is None else img_output.with_name(img_output.stem) / f"{page}{img_output.suffix}"
+
+        if writer is not None:
+            if not writer.write(output.as_posix(), data):
+                logger.warning(f"{output} already exists in {writer.path}, so it is skipped.")
+                continue
+            logger.info(f"successfully converted {name} into {writer.path}/{output.as_posix()}")
+
+        else:
+            path = Path(output)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+            logger.info(f"successfully converted {name} into {path}")
+
+
+def run_task(worker: Optional[IsolatedWorker], name: str, func: Callable[..., Any], *args: Any) -> TaskResult:
+    if worker is None:
+        return TaskResult(True, "", func(*args))
+
+    result = worker.call(func, *args)
+    if not result.ok:
+        logger.error(f"failed to process {name}: {result.reason}")
+
+    return result
+
+
+def convert_archive(archive: Path, out: str, writer: Optional[ArchiveWriter], worker: Optional[IsolatedWorker],
+                    options: Tuple[Preprocessor, Dict[str, Any], Dict[str, Any]]) -> bool:
+    # 子プロセスのメモリ上限を超えるメンバーは、このプロセスで展開する前に失敗とする(zip bomb対策)
+    max_member_size = None
+    if worker is not None and worker.max_memory is not None:
+        max_member_size = worker.max_memory * 1024 * 1024
+
+    ok = True
+    try:
+        for member, stream in iter_archive_members(archive):
+            name = f"{archive}/{member}"
+            if not is_safe_member(member):
+                logger.error(f"{name} points outside of the output, so it is skipped.")
+                ok = False
+                continue
+
+            data = stream.read() if max_member_size is None else stream.read(max_member_size + 1)
+            if max_member_size is not None and len(data) > max_member_size:
+                logger.error(f"{name} is larger than --max-memory when extracted, so it is skipped.")
+                ok = False
+                continue
+
+            if writer is not None:
+                img_output: PurePath = resolve_member_name(member, out)
+            else:
+                img_output = resolve_output_file_path(member, out)
+
+            result = run_task(worker, name, convert_data, data, name, img_output.suffix, *options)
+            if not result.ok or result.value is None:
+                ok = False
+                continue
+
+            write_outputs(result.value, name, img_output, writer)
+
+    except ARCHIVE_ERRORS as err:
+        logger.error(f"failed to read {archive}: {err}")
+        return False
+
+    return ok
+
+
+def write_retry_list(retry_list: Path, failed_inputs: List[Path], options: List[str]):
+    if not failed_inputs:
+        if retry_list.exists():
+            retry_list.unlink()
+            logger.info(f"all files are converted, so {retry_list} is removed.")
+        return
+
+    # argparseのfromfile_prefix_charsで読み込めるよう、1行に1引数を書く
+    lines = ["-i", *[str(img_input.absolute()) for img_input in failed_inputs], *options]
+    retry_list.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    logger.warning(f"{len(failed_inputs)} files failed. retry them with `imgconv @{retry_list}`")
+
+
 def main():
-    """ エントリーポイント """
     args = parse()
 
     img_inputs = args.inputs
     out = args.output
 
-    preprocessor = Preprocessor(do_crop_center=args.crop, do_round=args.round, round_rate=args.round_rate)
-    pdf2image_options = {"dpi": args.dpi}
-
-    for img_input in get_img_inputs_from_user_inputs(img_inputs):
-        img_output = resolve_output_file_path(img_input, out)
-        if img_input.suffix == ".exe":
-            extract_icon(img_input, img_output)
-
-        else:
-            convert(img_input, img_output, preprocessor, pdf2image_options)
+    byte_budget = None
+    if args.max_bytes is not None:
+        byte_budget = ByteBudget(args.max_bytes, allow_scale=args.allow_scale, jobs=args.max_bytes_jobs)
+    preprocessor = Preprocessor(do_crop_center=args.crop, do_round=args.round, round_rate=args.round_rate,
+                                strip_metadata=args.strip_metadata, byte_budget=byte_budget)
+    # Windowsではpopplerのプロセスをまとめて終了できないので、pdf2imageにもタイムアウトを渡す
+    pdf2image_options = {"dpi": args.dpi, "timeout": args.timeout}
+    icon_options = {"size": args.icon_size, "bit_depth": args.icon_bit_depth}
+    options = (preprocessor, pdf2image_options, icon_options)
+
+    archive_path, member_pattern = split_archive_path(out)
+    use_worker = args.timeout is not None or args.max_memory is not None or args.retry_list is not None
+
+    # 出力先のアーカイブを開く前に入力を列挙し、書き込み中のアーカイブを入力として拾わないようにする
+    img_input_list = list(get_img_inputs_from_user_inputs(img_inputs))
+
+    failed_inputs: List[Path] = []
+    with ExitStack() as stack:
+        worker: Optional[IsolatedWorker] = None
+        if use_worker:
+            worker = stack.enter_context(IsolatedWorker(logger, timeout=args.timeout, max_memory=args.max_memory,
+                                                        max_tasks=args.max_tasks_per_worker))
+        writer: Optional[ArchiveWriter] = None
+        if archive_path is not None:
+            writer = stack.enter_context(ArchiveWriter(archive_path))
+
+        for img_input in img_input_list:
+            if not img_input.is_file():
+                # globに一致したディレクトリなど
+                logger.error(f"{img_input} is not a file, so it is skipped.")
+                continue
+
+            if archive_path is not None and img_input.resolve() == archive_path.resolve():
+                logger.error(f"{img_input} is the output archive itself, so it is skipped.")
+                continue
+
+            if is_archive(img_input):
+                ok = convert_archive(img_input, member_pattern, writer, worker, options)
+
+            elif writer is not None:
+                img_output = resolve_member_name(to_member_path(img_input), member_pattern)
+                result = run_task(worker, str(img_input), convert_data,
+                                  img_input.read_bytes(), str(img_input), img_output.suffix, *options)
+                ok = result.ok and result.value is not None
+                if ok:
+                    write_outputs(result.value, str(img_input), img_output, writer)
+
+            else:
+                img_output = resolve_output_file_path(img_input, out)
+                result = run_task(worker, str(img_input), convert, img_input, img_output, *options)
+                # 変換関数がエラーを握りつぶして失敗を返した場合も、失敗として記録する
+                ok = result.ok and bool(result.value)
+
+            if not ok:
+                failed_inputs.append(img_input)
+
+    if args.retry_list is not None:
+        write_retry_list(Path(args.retry_list), failed_inputs, format_options(args))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,213 @@
+"""
+zip/tarアーカイブのメンバーを、ディスクに展開せずに読み書きするモジュール。
+"""
+from pathlib import Path, PurePath, PurePosixPath, PureWindowsPath
+from typing import BinaryIO, Iterator, Optional, Set, Tuple
+import io
+import lzma
+import os
+import tarfile
+import time
+import zipfile
+import zlib
+
+# アーカイブの拡張子と、tarfile.openに渡す書き込みモード. zipはNone
+ARCHIVE_SUFFIXES = {
+    ".zip": None,
+    ".tar": "w",
+    ".tar.gz": "w:gz",
+    ".tgz": "w:gz",
+    ".tar.bz2": "w:bz2",
+    ".tbz2": "w:bz2",
+    ".tar.xz": "w:xz",
+    ".txz": "w:xz",
+}
+
+# 壊れた・途中で切れたアーカイブを読んだ時に送出されるエラー
+ARCHIVE_ERRORS = (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError, zlib.error, lzma.LZMAError)
+
+
+def get_archive_suffix(path: PurePath) -> Optional[str]:
+    """ アーカイブの拡張子を返す. アーカイブでなければNone """
+    name = path.name.lower()
+    for suffix in ARCHIVE_SUFFIXES:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return suffix
+
+    return None
+
+
+def is_archive(path: PurePath) -> bool:
+    """ 拡張子からアーカイブかどうかを判定する """
+    return get_archive_suffix(path) is not None
+
+
+def split_archive_path(out: str) -> Tuple[Optional[Path], str]:
+    """出力先を、アーカイブのパスとアーカイブ内のメンバー名に分ける
+
+    `out.zip/${dir}/${stem}.png`のように、途中にアーカイブの拡張子を持つ要素があれば、
+    そこまでをアーカイブのパス、それ以降をメンバー名とする。
+
+    Args:
+        out (str): 出力先の情報. ${stem}, ${dir}を含む可能性がある。
+
+    Raises:
+        ValueError: アーカイブ内のメンバー名が指定されていない時
+
+    Returns:
+        Tuple[Optional[Path], str]: アーカイブのパスとメンバー名. アーカイブでなければ(None, out)
+    """
+    parts = out.replace("\\", "/").split("/")
+    for i, part in enumerate(parts):
+        if not is_archive(PurePosixPath(part)):
+            continue
+
+        member = "/".join(parts[i + 1:])
+        if not member:
+            raise ValueError(f"specify the member name in the archive, such as {out}/${{stem}}.png")
+        return Path("/".join(parts[:i + 1])), member
+
+    return None, out
+
+
+def to_member_path(path: Path) -> PurePosixPath:
+    """ ファイルのパスを、アーカイブのメンバー名として使える相対パスにする """
+    try:
+        relative = path.absolute().relative_to(Path.cwd())
+    except ValueError:
+        relative = Path(*path.absolute().parts[1:])
+
+    return PurePosixPath(relative.as_posix())
+
+
+def is_safe_member(member: PurePosixPath) -> bool:
+    """ 絶対パスや..を含まず、${dir}に使っても出力先の外に書き出されないメンバー名か """
+    # Windowsのドライブ名やバックスラッシュ区切りも考慮する
+    windows_path = PureWindowsPath(str(member))
+    if member.is_absolute() or windows_path.drive or windows_path.root:
+        return False
+
+    return ".." not in member.parts and ".." not in windows_path.parts
+
+
+def iter_archive_members(path: Path) -> Iterator[Tuple[PurePosixPath, BinaryIO]]:
+    """アーカイブのメンバーを、名前と読み込み用のストリームの組で順に返す
+
+    tarはストリームとして先頭から順に読むので、返されたストリームは次のメンバーに進む前に読むこと。
+    壊れたアーカイブでは、途中でARCHIVE_ERRORSのいずれかが送出される。
+
+    Args:
+        path (Path): アーカイブのパス
+
+    Yields:
+        Iterator[Tuple[PurePosixPath, BinaryIO]]: メンバー名とストリーム
+    """
+    if get_archive_suffix(path) == ".zip":
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                with zf.open(info) as stream:
+                    yield PurePosixPath(info.filename), stream
+
+    else:
+        with tarfile.open(path, "r|*") as tf:
+            for member in tf:
+                if not member.isfile():
+                    continue
+                stream = tf.extractfile(member)
+                if stream is not None:
+                    yield PurePosixPath(member.name), stream
+
+
+def is_valid_archive(path: Path) -> bool:
+    """ 読み込めるアーカイブか """
+    if get_archive_suffix(path) == ".zip":
+        return zipfile.is_zipfile(path)
+
+    return tarfile.is_tarfile(path)
+
+
+class ArchiveWriter:
+    """メモリ上のデータを、メンバーとしてアーカイブに書き込むクラス
+
+    書き込みは一時ファイルに行い、閉じる時にアーカイブと置き換える。
+    既にアーカイブがある場合は、今回書き込まなかったメンバーを引き継ぐので、
+    一部のファイルだけを変換し直しても、前回変換したメンバーは残る。
+
+    """
+
+    def __init__(self, path: Path) -> None:
+        suffix = get_archive_suffix(path)
+        if suffix is None:
+            raise ValueError(f"{path} is not an archive.")
+
+        if path.exists() and not is_valid_archive(path):
+            raise ValueError(f"{path} already exists, but it is not a valid archive.")
+
+        self.path = path
+        self._tmp = path.with_name(f".{path.name}.tmp")
+        self._names: Set[str] = set()
+        self._zip: Optional[zipfile.ZipFile] = None
+        self._tar: Optional[tarfile.TarFile] = None
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        mode = ARCHIVE_SUFFIXES[suffix]
+        if mode is None:
+            self._zip = zipfile.ZipFile(self._tmp, "w", compression=zipfile.ZIP_DEFLATED)
+        else:
+            self._tar = tarfile.open(self._tmp, mode)     # pylint: disable=consider-using-with
+
+    def __enter__(self) -> "ArchiveWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def write(self, name: str, data: bytes) -> bool:
+        """メンバーを書き込む
+
+        Args:
+            name (str): メンバー名
+            data (bytes): 書き込むデータ
+
+        Returns:
+            bool: 書き込んだ場合はTrue. 同じ名前のメンバーが既にある場合は書き込まずにFalse
+        """
+        name = PurePosixPath(name).as_posix()
+        if name in self._names:
+            return False
+        self._names.add(name)
+
+        if self._zip is not None:
+            self._zip.writestr(name, data)
+
+        elif self._tar is not None:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self._tar.addfile(info, io.BytesIO(data))
+
+        return True
+
+    def close(self):
+        """ 既存のアーカイブのメンバーを引き継いでから閉じ、アーカイブと置き換える """
+        if self._zip is None and self._tar is None:
+            return
+
+        try:
+            if self.path.exists():
+                for member, stream in iter_archive_members(self.path):
+                    # 今回書き込んだメンバーは、writeが上書きせずにFalseを返す
+                    self.write(member.as_posix(), stream.read())
+
+        finally:
+            if self._zip is not None:
+                self._zip.close()
+                self._zip = None
+
+            if self._tar is not None:
+                self._tar.close()
+                self._tar = None
+
+        os.replace(self._tmp, self.path)
@@ -0,0 +1,188 @@
+"""
+出力のバイト数が指定した上限に収まるよう、エンコードの設定をメモリ上で探すモジュール。
+"""
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Callable, List, NamedTuple, Optional, Tuple
+import io
+
+from PIL import Image
+
+# qualityを指定できる形式と、その範囲
+QUALITY_RANGES = {
+    "JPEG": (10, 95),
+    "WEBP": (10, 100),
+}
+
+# 縮小する際の倍率(%)の範囲
+SCALE_RANGE = (1, 99)
+
+
+class ByteBudget(NamedTuple):
+    """出力のバイト数の上限と、探索の方法
+
+    Attributes:
+        max_bytes (int): 出力のバイト数の上限
+        allow_scale (bool): qualityを下げても収まらない場合に、縮小も試すか
+        jobs (int): 同時にエンコードを試す数. 1なら二分探索になる。
+    """
+    max_bytes: int
+    allow_scale: bool = False
+    jobs: int = 1
+
+
+class ByteBudgetResult(NamedTuple):
+    """探索の結果
+
+    Attributes:
+        data (Optional[bytes]): 上限に収まったデータ. 収まらなかった場合はNone
+        attempts (int): エンコードを試した回数
+        quality (Optional[int]): 使ったquality. qualityを指定できない形式ではNone
+        scale (int): 使った倍率(%)
+    """
+    data: Optional[bytes]
+    attempts: int
+    quality: Optional[int] = None
+    scale: int = 100
+
+
+def encode_image(image: Image.Image, image_format: str, quality: Optional[int] = None, scale: int = 100) -> bytes:
+    """画像をメモリ上にエンコードする
+
+    Args:
+        image (Image.Image): 入力画像
+        image_format (str): pillowの形式名
+        quality (Optional[int], optional): quality. Noneなら指定しない. Defaults to None.
+        scale (int, optional): 倍率(%). Defaults to 100.
+
+    Returns:
+        bytes: エンコードしたデータ
+    """
+    if scale != 100:
+        width, height = image.size
+        size = (max(1, width * scale // 100), max(1, height * scale // 100))
+        image = image.resize(size, Image.Resampling.LANCZOS)
+    else:
+        # saveは画像にencoderinfoを書き込むので、同時に試す時のためにコピーしてから使う
+        image = image.copy()
+
+    params = {}
+    if quality is not None:
+        params["quality"] = quality
+    if image_format == "PNG":
+        params["optimize"] = True
+
+    buf = io.BytesIO()
+    image.save(buf, format=image_format, **params)
+    return buf.getvalue()
+
+
+def search_largest_fit(
+        lo: int,
+        hi: int,
+        encode: Callable[[int], bytes],
+        max_bytes: int,
+        executor: Optional[Executor] = None,
+        jobs: int = 1) -> Tuple[Optional[Tuple[int, bytes]], int]:
+    """上限に収まる、[lo, hi]の中で最大の値を探す
+
+    値が大きいほどエンコードしたデータも大きくなることを前提に、二分探索する。
+    executorがある場合は、1回にjobs個の値を同時に試して区間をjobs + 1個に分ける。
+
+    Args:
+        lo (int): 探索する範囲の下限
+        hi (int): 探索する範囲の上限
+        encode (Callable[[int], bytes]): 値を受け取ってエンコードする関数
+        max_bytes (int): バイト数の上限
+        executor (Optional[Executor], optional): 同時に試すためのExecutor. Defaults to None.
+        jobs (int, optional): 1回に同時に試す数. Defaults to 1.
+
+    Returns:
+        Tuple[Optional[Tuple[int, bytes]], int]: 収まった最大の値とそのデータ(無ければNone)と、試した回数
+    """
+    best: Optional[Tuple[int, bytes]] = None
+    attempts = 0
+
+    while lo <= hi:
+        if executor is None or jobs <= 1:
+            candidates = [(lo + hi) // 2]
+        else:
+            candidates = sorted({lo + (hi - lo) * (i + 1) // (jobs + 1) for i in range(jobs)})
+
+        if executor is None:
+            results: List[bytes] = [encode(value) for value in candidates]
+        else:
+            results = list(executor.map(encode, candidates))
+        attempts += len(candidates)
+
+        new_lo, new_hi = lo, hi
+        for value, data in zip(candidates, results):
+            if len(data) > max_bytes:
+                # これより大きい値も収まらないとみなす
+                new_hi = value - 1
+                break
+
+            best = (value, data)
+            new_lo = value + 1
+
+        lo, hi = new_lo, new_hi
+
+    return best, attempts
+
+
+def fit_to_budget(image: Image.Image, image_format: str, budget: ByteBudget) -> ByteBudgetResult:
+    """デコード・前処理済みの画像を、上限に収まる設定でエンコードする
+
+    qualityを指定できる形式では、まずqualityを探す。
+    収まらず、縮小が許可されている場合は、最低のqualityで収まる最大の倍率を探してから、その倍率でqualityを探し直す。
+
+    Args:
+        image (Image.Image): 入力画像
+        image_format (str): pillowの形式名
+        budget (ByteBudget): 上限と探索の方法
+
+    Returns:
+        ByteBudgetResult: 探索の結果
+    """
+    quality_range = QUALITY_RANGES.get(image_format)
+    image.load()
+
+    with ThreadPoolExecutor(max_workers=budget.jobs) if budget.jobs > 1 else nullcontext() as executor:
+        attempts = 0
+
+        def search(lo: int, hi: int, encode: Callable[[int], bytes]) -> Optional[Tuple[int, bytes]]:
+            nonlocal attempts
+            found, n = search_largest_fit(lo, hi, encode, budget.max_bytes, executor, budget.jobs)
+            attempts += n
+            return found
+
+        if quality_range is None:
+            data = encode_image(image, image_format)
+            attempts += 1
+            if len(data) <= budget.max_bytes:
+                return ByteBudgetResult(data, attempts)
+
+        else:
+            found = search(*quality_range, lambda quality: encode_image(image, image_format, quality))
+            if found is not None:
+                return ByteBudgetResult(found[1], attempts, quality=found[0])
+
+        if not budget.allow_scale:
+            return ByteBudgetResult(None, attempts)
+
+        min_quality = quality_range[0] if quality_range is not None else None
+        found = search(*SCALE_RANGE, lambda scale: encode_image(image, image_format, min_quality, scale))
+        if found is None:
+            return ByteBudgetResult(None, attempts)
+
+        scale, data = found
+        if quality_range is None:
+            return ByteBudgetResult(data, attempts, scale=scale)
+
+        # 最低のqualityでは収まることが分かっているので、それより上を探す
+        best = search(min_quality + 1, quality_range[1],
+                      lambda quality: encode_image(image, image_format, quality, scale))
+        if best is None:
+            return ByteBudgetResult(data, attempts, quality=min_quality, scale=scale)
+        return ByteBudgetResult(best[1], attempts, quality=best[0], scale=scale)
+
@@ -1,9 +1,12 @@
 """
 CLIのパーサー部分を記述したモジュール。
 """
-from typing import List, NamedTuple
+from typing import List, NamedTuple, Optional
 import argparse
 
+# バイト数の指定に使える単位
+BYTE_UNITS = {"K": 1024, "M": 1024 * 1024}
+
 
 class Args(NamedTuple):
     """パーサーで取得した変数を補間するための、仮のタイプ定義。
@@ -15,11 +18,35 @@ class Args(NamedTuple):
     crop: bool
     round: bool
     round_rate: int
+    strip_metadata: bool
+    icon_size: Optional[int]
+    icon_bit_depth: Optional[int]
+    max_bytes: Optional[int]
+    allow_scale: bool
+    max_bytes_jobs: int
+    timeout: Optional[float]
+    max_memory: Optional[int]
+    max_tasks_per_worker: int
+    retry_list: Optional[str]
 
 
-def parse(*args, **kwargs) -> Args:
-    """ コマンドラインをパースした結果を返す """
-    parser = argparse.ArgumentParser()
+def parse_byte_size(value: str) -> int:
+    """ 50K, 2Mのような単位付きのバイト数を解釈する """
+    unit = BYTE_UNITS.get(value[-1:].upper(), 1)
+    number = value[:-1] if unit != 1 else value
+    try:
+        size = int(float(number) * unit)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(f"invalid byte size: {value}") from err
+
+    if size <= 0:
+        raise argparse.ArgumentTypeError(f"byte size must be positive: {value}")
+    return size
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """ imgconvのパーサーを作る """
+    parser = argparse.ArgumentParser(prog="imgconv", fromfile_prefix_chars="@")
 
     parser.add_argument("-i", "--inputs", required=True, nargs="+", help="pngなどの画像ファイル")
     parser.add_argument("-o", "--output", required=True,
@@ -30,6 +57,59 @@ def parse(*args, **kwargs) -> Args:
     parser.add_argument("--round", action="store_true", help="icoへ変換時、角丸にトリミングを行ってから処理をするか。")
     parser.add_argument("--round-rate", type=int, default=5, help="角丸にトリミングする際の、サイズに対する半径の比。大きいと半径は小さくなる。2でピッタリな円になる。")
 
-    namespace: Args = parser.parse_args(*args, **kwargs)        # type: ignore
+    parser.add_argument("--strip-metadata", action="store_true",
+                        help="Exifやテキストなどのメタデータを取り除く。入力と出力が同じ形式なら、画素を触らずに取り除く。")
+
+    parser.add_argument("--icon-size", type=int, default=None,
+                        help="exeからiconを取り出す際、指定したサイズ(px)のiconだけを取り出す。")
+    parser.add_argument("--icon-bit-depth", type=int, default=None,
+                        help="exeからiconを取り出す際、指定したビット深度のiconだけを取り出す。")
+
+    parser.add_argument("--max-bytes", type=parse_byte_size, default=None,
+                        help="出力のバイト数の上限。50K, 2Mのように単位を付けられる。qualityなどを探して上限に収める。")
+    parser.add_argument("--allow-scale", action="store_true", help="--max-bytesに収まらない場合に、画像の縮小も試すか。")
+    parser.add_argument("--max-bytes-jobs", type=int, default=1, help="--max-bytesの探索で、同時にエンコードを試す数。")
+
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="1ファイルあたりの変換時間の上限(秒)。指定すると変換は子プロセスで行われる。")
+    parser.add_argument("--max-memory", type=int, default=None,
+                        help="変換を行う子プロセスのメモリ上限(MB)。指定すると変換は子プロセスで行われる。")
+    parser.add_argument("--max-tasks-per-worker", type=int, default=100, help="子プロセスを作り直すまでに処理するファイル数。")
+    parser.add_argument("--retry-list", default=None,
+                        help="失敗したファイルを記録するファイル。`imgconv @retry-list`で再実行できる。指定すると変換は子プロセスで行われる。")
+
+    return parser
+
+
+def parse(*args, **kwargs) -> Args:
+    """ コマンドラインをパースした結果を返す """
+    namespace: Args = build_parser().parse_args(*args, **kwargs)        # type: ignore
 
     return namespace
+
+
+def format_options(args: Args) -> List[str]:
+    """入力ファイル以外の引数を、parseで読み込める引数のリストに戻す
+
+    デフォルト値のままのオプションは省く。
+
+    Args:
+        args (Args): parseの返り値
+
+    Returns:
+        List[str]: `-o out.png --crop`のような引数のリスト
+    """
+    parser = build_parser()
+    options: List[str] = []
+
+    for dest, value in vars(args).items():
+        if dest == "inputs" or value is None or value == parser.get_default(dest):
+            continue
+
+        flag = f"--{dest.replace('_', '-')}"
+        if isinstance(value, bool):
+            options.append(flag)
+        else:
+            options.extend([flag, str(value)])
+
+    return options
@@ -0,0 +1,87 @@
+"""
+入力の形式ごとに、変換を行うバックエンドを登録・選択するモジュール。
+"""
+from typing import Any, Callable, FrozenSet, List, NamedTuple, Optional, Set
+
+
+def accept_any_output(_suffix: str) -> bool:
+    """ どの拡張子にも出力できる """
+    return True
+
+
+def accept_any_preprocessor(_preprocessor: Any) -> bool:
+    """ どの前処理の指定でも変換できる """
+    return True
+
+
+class ConverterBackend(NamedTuple):
+    """変換を行うバックエンド
+
+    Attributes:
+        name (str): バックエンド名
+        input_formats (FrozenSet[str]): 入力できる形式名の集合. formatsnifferで判別される形式名。
+        convert (Callable[..., Any]): convert(img_input, img_output, preprocessor, pdf2image_options, icon_options)の形で
+            呼ばれ、変換に成功したかを返す関数
+        can_output (Callable[[str], bool]): 出力の拡張子を受け取り、出力できるかを返す関数
+        cost (int): 変換のコスト. 同じ入力・出力を扱えるバックエンドのうち、最もコストの低いものが選ばれる。
+        can_preprocess (Callable[[Any], bool]): 前処理用インスタンスを受け取り、その指定通りに変換できるかを返す関数
+        convert_data (Optional[Callable[..., Any]]): convert_data(data, output_suffix, preprocessor, pdf2image_options,
+            icon_options)の形で呼ばれ、メモリ上で変換した(ページ名, データ)のリストを返す関数. 対応しない場合はNone
+    """
+    name: str
+    input_formats: FrozenSet[str]
+    convert: Callable[..., Any]
+    can_output: Callable[[str], bool] = accept_any_output
+    cost: int = 0
+    can_preprocess: Callable[[Any], bool] = accept_any_preprocessor
+    convert_data: Optional[Callable[..., Any]] = None
+
+
+class ConverterRegistry:
+    """変換バックエンドの登録先
+
+    """
+
+    def __init__(self) -> None:
+        self._backends: List[ConverterBackend] = []
+
+    def register(self, backend: ConverterBackend):
+        """ バックエンドを登録する """
+        self._backends.append(backend)
+        self._backends.sort(key=lambda b: b.cost)
+
+    def find(
+            self,
+            input_format: str,
+            output_suffix: str,
+            preprocessor: Any = None,
+            in_memory: bool = False) -> Optional[ConverterBackend]:
+        """入力の形式と出力の拡張子から、最もコストの低いバックエンドを返す
+
+        Args:
+            input_format (str): 入力の形式名
+            output_suffix (str): 出力の拡張子
+            preprocessor (Any, optional): 前処理用インスタンス. Noneの場合は前処理の指定を考慮しない。
+            in_memory (bool, optional): メモリ上で変換できるバックエンドだけを探すか. Defaults to False.
+
+        Returns:
+            Optional[ConverterBackend]: 変換できるバックエンドが無い場合はNone
+        """
+        for backend in self._backends:
+            if input_format not in backend.input_formats or not backend.can_output(output_suffix):
+                continue
+
+            if in_memory and backend.convert_data is None:
+                continue
+
+            if preprocessor is None or backend.can_preprocess(preprocessor):
+                return backend
+
+        return None
+
+    def supported_formats(self) -> Set[str]:
+        """ 入力できる形式名の集合を返す """
+        formats: Set[str] = set()
+        for backend in self._backends:
+            formats |= backend.input_formats
+        return formats
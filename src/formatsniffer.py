@@ -0,0 +1,82 @@
+"""
+ファイルの先頭の数バイトから、ファイルの形式を判別するモジュール。
+"""
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+# 判別に読み込むバイト数
+HEAD_SIZE = 16
+
+# (形式名, ((オフセット, マジックナンバー), ...))
+# 形式名はpillowのformatを小文字にしたものに合わせる。
+SIGNATURES: List[Tuple[str, Tuple[Tuple[int, bytes], ...]]] = [
+    ("png", ((0, b"\x89PNG\r\n\x1a\n"),)),
+    ("jpeg", ((0, b"\xff\xd8\xff"),)),
+    ("gif", ((0, b"GIF87a"),)),
+    ("gif", ((0, b"GIF89a"),)),
+    ("pdf", ((0, b"%PDF-"),)),
+    ("pe", ((0, b"MZ"),)),
+    ("bmp", ((0, b"BM"),)),
+    ("ico", ((0, b"\x00\x00\x01\x00"),)),
+    ("cur", ((0, b"\x00\x00\x02\x00"),)),
+    ("icns", ((0, b"icns"),)),
+    ("eps", ((0, b"%!PS"),)),
+    ("eps", ((0, b"\xc5\xd0\xd3\xc6"),)),
+    ("tiff", ((0, b"II*\x00"),)),
+    ("tiff", ((0, b"MM\x00*"),)),
+    ("webp", ((0, b"RIFF"), (8, b"WEBP"))),
+    ("jpeg2000", ((0, b"\x00\x00\x00\x0cjP  \r\n\x87\n"),)),
+    ("jpeg2000", ((0, b"\xff\x4f\xff\x51"),)),
+    ("psd", ((0, b"8BPS"),)),
+    ("qoi", ((0, b"qoif"),)),
+    ("msp", ((0, b"DanM"),)),
+    ("msp", ((0, b"LinS"),)),
+    ("sgi", ((0, b"\x01\xda"),)),
+    ("im", ((0, b"Image type"),)),
+    ("xbm", ((0, b"#define"),)),
+]
+
+
+def sniff_format_from_bytes(head: bytes) -> Optional[str]:
+    """先頭のバイト列からファイルの形式を判別する
+
+    Args:
+        head (bytes): ファイルの先頭のバイト列. HEAD_SIZEバイトあれば十分。
+
+    Returns:
+        Optional[str]: 形式名. 判別できなかった場合はNone
+    """
+    for format_name, magics in SIGNATURES:
+        if all(head[offset:offset + len(magic)] == magic for offset, magic in magics):
+            return format_name
+
+    # P1~P6の後に空白が続くもの(PBM, PGM, PPM)
+    if len(head) >= 3 and head[:1] == b"P" and head[1:2] in b"123456" and head[2:3].isspace():
+        return "ppm"
+
+    # 0x0A, バージョン, エンコーディング(1: RLE)の順に並ぶもの
+    if len(head) >= 3 and head[0] == 0x0A and head[1] in (0, 2, 3, 4, 5) and head[2] == 1:
+        return "pcx"
+
+    return None
+
+
+def sniff_format(path: Path) -> Optional[str]:
+    """ファイルの先頭の数バイトだけを読み、ファイルの形式を判別する
+
+    Args:
+        path (Path): 判別するファイル
+
+    Returns:
+        Optional[str]: 形式名. 判別できなかった場合や、通常のファイルでない・読めない場合はNone
+    """
+    if not path.is_file():
+        return None
+
+    try:
+        with open(path, "rb") as f:
+            head = f.read(HEAD_SIZE)
+    except OSError:
+        return None
+
+    return sniff_format_from_bytes(head)
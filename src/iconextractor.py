@@ -34,6 +34,7 @@ SOFTWARE.
 import io
 import logging
 import struct
+from typing import Optional
 import pefile
 
 GRPICONDIRENTRY_FORMAT = ('GRPICONDIRENTRY',
@@ -54,6 +55,10 @@ class InvalidIconDefinitionError(IconExtractorError):
     pass
 
 
+class IconNotFoundError(IconExtractorError):
+    pass
+
+
 class IconExtractor():
     """IconExtractor from exe file.
 
@@ -61,12 +66,18 @@ class IconExtractor():
 
     """
 
-    def __init__(self, filename: str, logger: logging.Logger):
+    def __init__(self, filename: str, logger: logging.Logger, data: Optional[bytes] = None):
+        """
+        When data is given, the executable is parsed from it instead of reading the file.
+        """
         self.filename = filename
         self.logger = logger
         # Use fast loading and explicitly load the RESOURCE directory entry. This saves a LOT of time
         # on larger files
-        self._pe = pefile.PE(filename, fast_load=True)
+        if data is None:
+            self._pe = pefile.PE(filename, fast_load=True)
+        else:
+            self._pe = pefile.PE(data=data, fast_load=True)
         self._pe.parse_data_directories(pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_RESOURCE'])
 
         if not hasattr(self._pe, 'DIRECTORY_ENTRY_RESOURCE'):
@@ -139,14 +150,11 @@ class IconExtractor():
             icons.append(data)
         return icons
 
-    def _write_ico(self, fd, num=0):
+    @staticmethod
+    def _write_ico_entries(fd, icons):
         """
-        Writes ICO data to a file descriptor.
+        Writes ICO data consisting of the given (GRPICONDIRENTRY, icon data) pairs to a file descriptor.
         """
-        group_icons = self._get_group_icon_entries(num=num)
-        icon_images = self._get_icon_data([g.ID for g in group_icons])
-        icons = list(zip(group_icons, icon_images))
-        assert len(group_icons) == len(icon_images)
         fd.write(b"\x00\x00")  # 2 reserved bytes
         fd.write(struct.pack("<H", 1))  # 0x1 (little endian) specifying that this is an .ICO image
         fd.write(struct.pack("<H", len(icons)))  # number of images
@@ -158,8 +166,9 @@ class IconExtractor():
             # Elements in ICONDIRENTRY and GRPICONDIRENTRY are all the same
             # except the last value, which is an ID in GRPICONDIRENTRY and
             # the offset from the beginning of the file in ICONDIRENTRY.
-            fd.write(group_icon.__pack__()[:12])
-            fd.write(struct.pack("<I", dataoffset))
+            # The data size is taken from the actual data, since it may have been rewritten (e.g. stripped)
+            fd.write(group_icon.__pack__()[:8])
+            fd.write(struct.pack("<II", len(icon_data), dataoffset))
             dataoffset += len(icon_data)  # Increase offset for next image
 
         # Second pass: write the icon data
@@ -167,6 +176,58 @@ class IconExtractor():
             group_icon, icon_data = datapair
             fd.write(icon_data)
 
+    def _write_ico(self, fd, num=0):
+        """
+        Writes ICO data to a file descriptor.
+        """
+        group_icons = self._get_group_icon_entries(num=num)
+        icon_images = self._get_icon_data([g.ID for g in group_icons])
+        icons = list(zip(group_icons, icon_images))
+        assert len(group_icons) == len(icon_images)
+        self._write_ico_entries(fd, icons)
+
+    @staticmethod
+    def get_entry_size(entry):
+        """
+        Returns the width of a group icon entry. A width of 0 means 256 pixels.
+        """
+        return entry.Width or 256
+
+    def select_icon_entry(self, num=0, size=None, bit_depth=None):
+        """
+        Returns a single group icon entry matching the given size and bit depth.
+        When they are not given, the largest size and the highest bit depth are selected.
+        """
+        entries = self._get_group_icon_entries(num=num)
+        available = ", ".join(f"{self.get_entry_size(e)}px/{e.BitCount}bit" for e in entries)
+
+        if bit_depth is not None:
+            entries = [e for e in entries if e.BitCount == bit_depth]
+        if size is not None:
+            entries = [e for e in entries if self.get_entry_size(e) == size]
+
+        if not entries:
+            raise IconNotFoundError(f"no icon of size={size}, bit_depth={bit_depth} (available: {available})")
+
+        return max(entries, key=lambda e: (self.get_entry_size(e), e.BitCount))
+
+    def get_icon_entry_data(self, num=0, size=None, bit_depth=None):
+        """
+        Returns the selected group icon entry and its raw data, which is either a PNG or a DIB.
+        Only the RT_ICON resource of the selected entry is read.
+        """
+        entry = self.select_icon_entry(num=num, size=size, bit_depth=bit_depth)
+        return entry, self._get_icon_data([entry.ID])[0]
+
+    def get_single_icon(self, entry, icon_data):
+        """
+        Returns ICO data as a BytesIO() instance, containing only the given entry.
+        """
+        f = io.BytesIO()
+        self._write_ico_entries(f, [(entry, icon_data)])
+        f.seek(0)
+        return f
+
     def export_icon(self, fname, num=0):
         """
         Writes ICO data containing the program icon of the input executable.
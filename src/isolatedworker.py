@@ -0,0 +1,186 @@
+"""
+変換処理を子プロセスで実行し、ハングやクラッシュからバッチ全体を隔離するモジュール。
+"""
+from multiprocessing.connection import Connection
+from typing import Any, Callable, NamedTuple, Optional
+import logging
+import multiprocessing
+import os
+import signal
+
+try:
+    import resource
+except ImportError:
+    # Windowsにはresourceモジュールが無いため、メモリ制限は行えない
+    resource = None     # pylint: disable=invalid-name
+
+
+class TaskResult(NamedTuple):
+    """子プロセスでの1タスクの実行結果
+
+    """
+    ok: bool
+    reason: str
+    value: Any = None
+
+
+def _limit_memory(max_memory: Optional[int]):
+    """ 子プロセスのアドレス空間の上限をMB単位で設定する """
+    if max_memory is None or resource is None:
+        return
+
+    limit = max_memory * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _worker_loop(conn: Connection, max_memory: Optional[int]):
+    """ 子プロセスのエントリーポイント. Noneを受け取るまで(関数, 引数)のタスクを処理し続ける """
+    if hasattr(os, "setsid"):
+        # popplerなどの孫プロセスもまとめて終了できるよう、新しいプロセスグループを作る
+        os.setsid()
+    _limit_memory(max_memory)
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+
+        if task is None:
+            break
+
+        func, args = task
+        try:
+            value = func(*args)
+        except MemoryError:
+            conn.send((False, "MemoryError: exceeded the memory limit", None))
+        except Exception as err:     # pylint: disable=broad-except
+            reason = f"{type(err).__name__}: {err}" if str(err) else type(err).__name__
+            conn.send((False, reason, None))
+        else:
+            conn.send((True, "", value))
+
+    conn.close()
+
+
+class IsolatedWorker:
+    """関数を子プロセスで実行するワーカー
+
+    タイムアウト・メモリ制限を超えたり、子プロセスが落ちたりしても本体は止まらない。
+    失敗した時と、max_tasks個のタスクを処理した時には子プロセスを作り直す。
+
+    """
+
+    def __init__(
+            self,
+            logger: logging.Logger,
+            *,
+            timeout: Optional[float] = None,
+            max_memory: Optional[int] = None,
+            max_tasks: int = 100) -> None:
+        self.logger = logger
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.max_tasks = max_tasks
+
+        if max_memory is not None and resource is None:
+            self.logger.warning("--max-memory is not supported on this platform, so it will be ignored.")
+
+        self._process: Optional[multiprocessing.Process] = None
+        self._conn: Optional[Connection] = None
+        self._done_tasks = 0
+
+    def __enter__(self) -> "IsolatedWorker":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _start(self):
+        """ 子プロセスを起動する """
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_worker_loop, args=(child_conn, self.max_memory), daemon=True)
+        self._process.start()
+        child_conn.close()
+
+        self._conn = parent_conn
+        self._done_tasks = 0
+        self.logger.debug(f"started a worker process (pid: {self._process.pid})")
+
+    def _stop(self, force: bool = False):
+        """子プロセスを終了する
+
+        Args:
+            force (bool, optional): 終了を待たずに、子プロセスが起動したプロセスごとkillするか. Defaults to False.
+        """
+        if self._process is None or self._conn is None:
+            return
+
+        if not force and self._process.is_alive():
+            try:
+                self._conn.send(None)
+            except OSError:
+                pass
+            self._process.join(timeout=5)
+
+        if force or self._process.is_alive():
+            self._kill_process_group()
+        self._process.join()
+        self._conn.close()
+
+        self.logger.debug(f"stopped a worker process (pid: {self._process.pid})")
+        self._process = None
+        self._conn = None
+
+    def _kill_process_group(self):
+        """ 子プロセスと、そこから起動されたプロセスをまとめて終了する """
+        assert self._process is not None
+
+        if hasattr(os, "killpg") and self._process.pid is not None:
+            try:
+                os.killpg(self._process.pid, signal.SIGKILL)
+                return
+            except OSError:
+                # setsidの前に終了させる時は、まだプロセスグループが無い
+                pass
+
+        if self._process.is_alive():
+            self._process.terminate()
+
+    def call(self, func: Callable[..., Any], *args: Any) -> TaskResult:
+        """子プロセスでfunc(*args)を実行する
+
+        Args:
+            func (Callable[..., Any]): 実行する関数. pickleできるよう、モジュールのトップレベルで定義されたもの。
+
+        Returns:
+            TaskResult: 実行結果. 成功した場合はvalueに関数の返り値が入り、失敗した場合はokがFalseで、reasonに理由が入る。
+        """
+        if self._process is None:
+            self._start()
+        assert self._process is not None and self._conn is not None
+
+        self._conn.send((func, args))
+
+        if not self._conn.poll(self.timeout):
+            self._stop(force=True)
+            return TaskResult(False, f"timed out after {self.timeout} seconds")
+
+        try:
+            ok, reason, value = self._conn.recv()
+        except EOFError:
+            self._process.join()
+            exitcode = self._process.exitcode
+            self._stop(force=True)
+            return TaskResult(False, f"the worker process crashed (exit code: {exitcode})")
+
+        self._done_tasks += 1
+        if not ok or self._done_tasks >= self.max_tasks:
+            self._stop()
+
+        return TaskResult(ok, reason, value)
+
+    def close(self):
+        """ 子プロセスを終了する """
+        self._stop()
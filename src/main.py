@@ -1,30 +1,61 @@
 """
 CLI本体を定義する。
 """
-from pathlib import Path
-from typing import Any, Dict, List
+from contextlib import ExitStack
+from functools import partial
+from pathlib import Path, PurePath, PurePosixPath
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import io
 
 from PIL import Image, ImageDraw, ImageFilter, UnidentifiedImageError
 import pdf2image
 
-from cliparser import parse
+from cliparser import format_options, parse
 from clilogger import Logger
+from converterregistry import ConverterBackend, ConverterRegistry
+from formatsniffer import HEAD_SIZE, sniff_format, sniff_format_from_bytes
+from passthrough import PASSTHROUGH_SUFFIXES, can_strip_metadata, copy_file, is_same_container, strip_metadata
+from passthrough import strip_metadata_from_bytes
 from iconextractor import IconExtractor, IconExtractorError
+from isolatedworker import IsolatedWorker, TaskResult
+from bytebudget import ByteBudget, fit_to_budget
+from archiveio import ArchiveWriter, is_archive, is_safe_member, iter_archive_members, split_archive_path
+from archiveio import ARCHIVE_ERRORS, to_member_path
 
 logger = Logger("imgconv")
 
 POPPLER_PATH = Path(__file__).parent.parent.absolute() / "poppler/bin"
 
+# アルファチャンネルを保存できない、pillowの形式名
+FORMATS_WITHOUT_ALPHA = {"EPS", "JPEG", "PCX", "PDF", "PPM"}
+
+# メモリ上で変換した結果. (ページ名, データ)のリストで、ページ名がNoneなら出力名そのままに書き出す
+ConvertedData = List[Tuple[Optional[str], bytes]]
+
 
 class Preprocessor:
     """前処理を行うクラス
 
     """
 
-    def __init__(self, *, do_crop_center: bool = False, do_round: bool = False, round_rate: int = 5) -> None:
+    def __init__(
+            self,
+            *,
+            do_crop_center: bool = False,
+            do_round: bool = False,
+            round_rate: int = 5,
+            strip_metadata: bool = False,
+            byte_budget: Optional[ByteBudget] = None) -> None:
         self.do_crop_center = do_crop_center
         self.do_round = do_round
         self.round_rate = round_rate
+        self.strip_metadata = strip_metadata
+        self.byte_budget = byte_budget
+
+    @property
+    def needs_pixel_work(self) -> bool:
+        """ 画素を加工する前処理が指定されているか """
+        return self.do_crop_center or self.do_round
 
     def preprocess(self, image_path: Path) -> Image.Image:
         """前処理を行った画像を返す
@@ -46,6 +77,17 @@ class Preprocessor:
             logger.exception(err)
             raise UnidentifiedImageError from err
 
+        return self.process(image)
+
+    def process(self, image: Image.Image) -> Image.Image:
+        """開いた画像に前処理を行う
+
+        Args:
+            image (Image.Image): 入力画像
+
+        Returns:
+            Image.Image: 前処理された画像
+        """
         if self.do_crop_center:
             image = self.crop_max_square(image)
 
@@ -147,28 +189,113 @@ class Preprocessor:
         return result
 
 
-def convert_by_pillow(image: Image.Image, img_output: Path):
+class ByteBudgetError(ValueError):
+    """ --max-bytesの上限に収まる設定が見つからなかった時のエラー """
+
+
+def save_to_bytes(image: Image.Image, suffix: str, byte_budget: Optional[ByteBudget] = None) -> bytes:
+    """pillowを用いて、メモリ上に画像を書き出す
+
+    Args:
+        image (Image.Image): 入力画像
+        suffix (str): 出力の拡張子. 書き出す形式の判定に使う。
+        byte_budget (Optional[ByteBudget], optional): バイト数の上限. 指定すると、上限に収まる設定を探す. Defaults to None.
+
+    Raises:
+        ByteBudgetError: 上限に収まる設定が見つからなかった時
+
+    Returns:
+        bytes: 書き出したデータ
+    """
+    image_format = Image.registered_extensions()[suffix.lower()]
+    if byte_budget is None:
+        buf = io.BytesIO()
+        image.save(buf, format=image_format)
+        return buf.getvalue()
+
+    result = fit_to_budget(image, image_format, byte_budget)
+    if result.data is None:
+        raise ByteBudgetError(f"could not fit the image into {byte_budget.max_bytes} bytes "
+                              f"after {result.attempts} attempts")
+
+    logger.info(f"fitted the image into {len(result.data)} bytes after {result.attempts} attempts "
+                f"(quality: {result.quality}, scale: {result.scale}%)")
+    return result.data
+
+
+def flatten_alpha(image: Image.Image, suffix: str) -> Image.Image:
+    """アルファチャンネルを保存できない形式へ出力する時、白い背景に重ねてRGBにする
+
+    Args:
+        image (Image.Image): 入力画像
+        suffix (str): 出力の拡張子
+
+    Returns:
+        Image.Image: 出力できるモードの画像. 変換が不要ならそのまま返す
+    """
+    if Image.registered_extensions().get(suffix.lower()) not in FORMATS_WITHOUT_ALPHA:
+        return image
+
+    if image.mode not in ("RGBA", "LA", "PA") and not (image.mode == "P" and "transparency" in image.info):
+        return image
+
+    rgba = image.convert("RGBA")
+    background = Image.new("RGB", rgba.size, "white")
+    background.paste(rgba, mask=rgba.getchannel("A"))
+    return background
+
+
+def save_image(image: Image.Image, img_output: Path, byte_budget: Optional[ByteBudget] = None):
+    """画像を保存する. byte_budgetがあれば、上限に収まる設定をメモリ上で探してから、結果だけを書き出す
+
+    Args:
+        image (Image.Image): 入力画像
+        img_output (Path): 出力画像名
+        byte_budget (Optional[ByteBudget], optional): バイト数の上限. Defaults to None.
+    """
+    if byte_budget is None:
+        image.save(img_output)
+
+    else:
+        img_output.write_bytes(save_to_bytes(image, img_output.suffix, byte_budget))
+
+
+def convert_by_pillow(image: Image.Image, img_output: Path, byte_budget: Optional[ByteBudget] = None) -> bool:
     """pillowを用いて画像を変換する
 
     Args:
         img_input (Image.Image): 入力画像
         img_output (Path): 出力画像名
+        byte_budget (Optional[ByteBudget], optional): バイト数の上限. Defaults to None.
+
+    Returns:
+        bool: 変換に成功した場合はTrue
     """
     try:
-        image.save(img_output)
+        save_image(image, img_output, byte_budget)
+
+    except ByteBudgetError as err:
+        # 上限に収まらないのは想定された結果なので、トレースバックは出さない
+        logger.error(f"failed to convert into {img_output}: {err}")
+        return False
 
     except (ValueError, OSError) as err:
         logger.error("failed to convert!")
         logger.exception(err)
+        return False
 
+    return True
 
-def convert_pdf(img_input: Path, img_output: Path, options: Dict[str, Any]) -> List[Image.Image]:
+
+def convert_pdf(img_input: Path, img_output: Path, options: Dict[str, Any],
+                byte_budget: Optional[ByteBudget] = None) -> List[Image.Image]:
     """PDFを入力画像として変換する
 
     Args:
         img_input (Path): 入力画像
         img_output (Path): 出力画像パス
         options (Dict[str, Any]): options for pdf2image.convert_from_path
+        byte_budget (Optional[ByteBudget], optional): 1ページあたりのバイト数の上限. Defaults to None.
 
     Returns:
         List[Image.Image]: images converted from pdf
@@ -176,7 +303,7 @@ def convert_pdf(img_input: Path, img_output: Path, options: Dict[str, Any]) -> L
     pages: List[Image.Image] = pdf2image.convert_from_path(
         img_input, **options, poppler_path=POPPLER_PATH)
     if len(pages) == 1:
-        pages[0].save(img_output)
+        save_image(pages[0], img_output, byte_budget)
 
     else:
         out_folder = img_output.with_name(img_output.stem)
@@ -185,89 +312,136 @@ def convert_pdf(img_input: Path, img_output: Path, options: Dict[str, Any]) -> L
         out_folder.mkdir(exist_ok=True)
 
         for i, page in enumerate(pages):
-            page.save(out_folder / f"{i}{fmt_out}")
+            save_image(page, out_folder / f"{i}{fmt_out}", byte_budget)
 
     return pages
 
 
-def convert(img_input: Path, img_output: Path, preprocessor: Preprocessor, pdf2image_options: Dict[str, Any]):
-    """画像・PDFを変換する
-
-    Args:
-        img_input (Path): 入力画像
-        img_output (Path): 出力画像パス
-        preprocessor (Preprocessor): 前処理用インスタンス
-        pdf2image_options (Dict[str, Any]): pdf2imageに渡すオプション
-    """
-    input_format = img_input.suffix
-    # output_format = img_output.suffix
-
-    pillow_permit_extensions = [
-        ".bmp",
-        ".eps",
-        ".gif",
-        ".icns",
-        ".ico",
-        ".im",
-        ".jpeg",
-        ".jfif",
-        ".jpg",
-        ".msp",
-        ".pcx",
-        ".png",
-        ".sgi",
-        ".xbm"
-    ]
-
-    if input_format == ".pdf":
-        convert_pdf(img_input, img_output, pdf2image_options)
-
-    elif input_format in pillow_permit_extensions:
-        image = preprocessor.preprocess(img_input)
-        convert_by_pillow(image, img_output)
-
-    else:
-        logger.error(f"The extension {input_format} is not permitted now...")
+def export_icon_data(
+        extractor: IconExtractor,
+        suffix: str,
+        num: int = 0,
+        *,
+        preprocessor: Optional[Preprocessor] = None,
+        size: Optional[int] = None,
+        bit_depth: Optional[int] = None) -> bytes:
+    """iconを取り出し、出力の拡張子に合わせたデータを返す
 
-    logger.info(f"successfully converted {img_input} into {img_output}")
+    icoへ出力し、サイズ・ビット深度・画素の加工の指定が無い場合は、icon group全体をそのまま書き出す。
+    それ以外の場合は、指定に合う1つのiconだけを読み込む。画素の加工やバイト数の上限が無ければ、
+    icoへはその1つだけを含むicoとして、PNGのiconはpngへそのまま、デコードせずに書き出す。
+    それ以外はメモリ上で変換する。
 
+    Args:
+        extractor (IconExtractor): 入力ファイルを開いたIconExtractor
+        suffix (str): 出力の拡張子. pillowで保存できる拡張子なら良い。
+        num (int, optional): 何番目のiconを出力するか. Defaults to 0.
+        preprocessor (Optional[Preprocessor], optional): 前処理用インスタンス. Defaults to None.
+        size (Optional[int], optional): 取り出すiconのサイズ(px). Noneなら最大のもの. Defaults to None.
+        bit_depth (Optional[int], optional): 取り出すiconのビット深度. Noneなら最大のもの. Defaults to None.
 
-def extract_icon(img_input: Path, img_output: Path, num: int = 0):
+    Returns:
+        bytes: 出力するデータ
+    """
+    needs_pixel_work = preprocessor is not None and preprocessor.needs_pixel_work
+    strips_metadata = preprocessor is not None and preprocessor.strip_metadata
+    byte_budget = preprocessor.byte_budget if preprocessor is not None else None
+    suffix = suffix.lower()
+
+    if suffix == ".ico" and size is None and bit_depth is None and not needs_pixel_work and byte_budget is None:
+        if strips_metadata:
+            logger.warning(f"the icon group of {extractor.filename} is copied as it is, so its metadata is kept. "
+                           "specify --icon-size or --icon-bit-depth to strip it from a single icon.")
+        return extractor.get_icon(num).getvalue()
+
+    entry, icon_data = extractor.get_icon_entry_data(num, size=size, bit_depth=bit_depth)
+    is_png = icon_data.startswith(b"\x89PNG")
+    logger.debug(f"selected the icon of {extractor.get_entry_size(entry)}px/{entry.BitCount}bit "
+                 f"({'PNG' if is_png else 'DIB'})")
+
+    if not needs_pixel_work and byte_budget is None:
+        if is_png and strips_metadata:
+            # PNGで埋め込まれているiconは、再エンコードせずにメタデータだけを取り除く
+            icon_data = strip_metadata_from_bytes(icon_data, "png")
+
+        if suffix == ".ico":
+            # pillowで保存すると複数のサイズが作られてしまうので、選んだiconだけをicoにまとめる
+            return extractor.get_single_icon(entry, icon_data).getvalue()
+
+        if is_png and suffix == ".png":
+            # PNGで埋め込まれているiconは、そのまま書き出す
+            return icon_data
+
+    # DIBのiconは、1つだけを含むicoとしてpillowで開く
+    stream = io.BytesIO(icon_data) if is_png else extractor.get_single_icon(entry, icon_data)
+    image = Image.open(stream)
+    if preprocessor is not None:
+        image = preprocessor.process(image)
+    # iconはRGBAなので、jpegなどへ出力する時は背景に重ねる
+    image = flatten_alpha(image, suffix)
+    return save_to_bytes(image, suffix, byte_budget)
+
+
+def extract_icon(
+        img_input: Path,
+        img_output: Path,
+        num: int = 0,
+        *,
+        preprocessor: Optional[Preprocessor] = None,
+        size: Optional[int] = None,
+        bit_depth: Optional[int] = None) -> bool:
     """exeからiconを取り出す
 
     Args:
         img_input (Path): 入力ファイル(.exe)
-        img_output (Path): 出力ファイル名(.ico)
+        img_output (Path): 出力ファイル名. pillowで保存できる拡張子なら良い。
         num (int, optional): 何番目のiconを出力するか. Defaults to 0.
-    """
-    if img_output.suffix != ".ico":
-        logger.error(f"IconExtractor do not support {img_output.suffix} now...")
-        logger.warning(f"failed to extract {img_input} into {img_output}.")
-        return
+        preprocessor (Optional[Preprocessor], optional): 前処理用インスタンス. Defaults to None.
+        size (Optional[int], optional): 取り出すiconのサイズ(px). Noneなら最大のもの. Defaults to None.
+        bit_depth (Optional[int], optional): 取り出すiconのビット深度. Noneなら最大のもの. Defaults to None.
 
+    Returns:
+        bool: 取り出しに成功した場合はTrue
+    """
     try:
-        IconExtractor(str(img_input), logger).export_icon(img_output, num)
+        extractor = IconExtractor(str(img_input), logger)
+        data = export_icon_data(extractor, img_output.suffix, num,
+                                preprocessor=preprocessor, size=size, bit_depth=bit_depth)
+        img_output.write_bytes(data)
+
     except IconExtractorError as err:
         logger.error(f"during extracting {img_input} into {img_output}, encountered an error: {err}")
         logger.warning("failed to extract.")
+    except ByteBudgetError as err:
+        logger.error(f"failed to convert into {img_output}: {err}")
+    except (ValueError, OSError) as err:
+        logger.error("failed to convert!")
+        logger.exception(err)
     else:
         logger.info(f"successfully extract {img_input} into {img_output}")
+        return True
+
+    return False
 
 
-def resolve_output_file_path(img_input: Path, out: str) -> Path:
+def substitute_output_variables(img_input: PurePath, out: str) -> str:
+    """ outに含まれる${stem}, ${dir}を、入力のパスで置き換える """
+    out = out.replace("${stem}", img_input.stem)
+    out = out.replace("${dir}", str(img_input.parent))
+    return out
+
+
+def resolve_output_file_path(img_input: PurePath, out: str) -> Path:
     """outの形式に応じて、出力先のパスを返す
 
     Args:
-        img_input (Path): 入力画像
+        img_input (PurePath): 入力画像. アーカイブのメンバーの場合は、アーカイブ内のパス。
         out (str): 出力先の情報(ファイルorディレクトリ), ${name}などを含む可能性がある。
 
     Returns:
         Path: 出力画像のパス
     """
-    out = out.replace("${stem}", img_input.stem)
-    out = out.replace("${dir}", str(img_input.parent))
-
-    img_output = Path(out)
+    img_output = Path(substitute_output_variables(img_input, out))
 
     if img_output.is_dir():
         raise ValueError("format of the output name is invalid.")
@@ -275,6 +449,11 @@ def resolve_output_file_path(img_input: Path, out: str) -> Path:
     return img_output
 
 
+def resolve_member_name(img_input: PurePath, pattern: str) -> PurePosixPath:
+    """ 出力先のアーカイブ内での、メンバー名を返す """
+    return PurePosixPath(substitute_output_variables(PurePosixPath(img_input.as_posix()), pattern))
+
+
 def get_img_inputs_from_user_inputs(inputs: List[str]):
     """ 入力されたファイルを順にイテレーションする """
     for pattern in inputs:
@@ -287,6 +466,329 @@ def get_img_inputs_from_user_inputs(inputs: List[str]):
                 yield img_input
 
 
+def can_save_by_pillow(suffix: str) -> bool:
+    """pillowで指定した拡張子の画像を保存できるか
+
+    Args:
+        suffix (str): 出力の拡張子
+
+    Returns:
+        bool: 保存できる場合はTrue
+    """
+    image_format = Image.registered_extensions().get(suffix.lower())
+    return image_format is not None and image_format in Image.SAVE
+
+
+def convert_image_by_pillow(img_input: Path, img_output: Path, preprocessor: Preprocessor,
+                            _pdf2image_options: Dict[str, Any], _icon_options: Dict[str, Any]) -> bool:
+    """ pillowで開ける画像を、前処理をしてから変換する """
+    image = preprocessor.preprocess(img_input)
+    if not convert_by_pillow(image, img_output, preprocessor.byte_budget):
+        return False
+
+    logger.info(f"successfully converted {img_input} into {img_output}")
+    return True
+
+
+def convert_pdf_by_pdf2image(img_input: Path, img_output: Path, preprocessor: Preprocessor,
+                             pdf2image_options: Dict[str, Any], _icon_options: Dict[str, Any]) -> bool:
+    """ PDFをpdf2imageで画像に変換する """
+    try:
+        convert_pdf(img_input, img_output, pdf2image_options, preprocessor.byte_budget)
+
+    except ByteBudgetError as err:
+        logger.error(f"failed to convert {img_input}: {err}")
+        return False
+
+    logger.info(f"successfully converted {img_input} into {img_output}")
+    return True
+
+
+def extract_icon_from_pe(img_input: Path, img_output: Path, preprocessor: Preprocessor,
+                         _pdf2image_options: Dict[str, Any], icon_options: Dict[str, Any]) -> bool:
+    """ exeなどのPEファイルからiconを取り出す """
+    return extract_icon(img_input, img_output, preprocessor=preprocessor, **icon_options)
+
+
+def convert_image_data(data: bytes, output_suffix: str, preprocessor: Preprocessor,
+                       _pdf2image_options: Dict[str, Any], _icon_options: Dict[str, Any]) -> ConvertedData:
+    """ pillowで開ける画像を、メモリ上で前処理をしてから変換する """
+    image = preprocessor.process(Image.open(io.BytesIO(data)))
+    return [(None, save_to_bytes(image, output_suffix, preprocessor.byte_budget))]
+
+
+def convert_pdf_data(data: bytes, output_suffix: str, preprocessor: Preprocessor,
+                     pdf2image_options: Dict[str, Any], _icon_options: Dict[str, Any]) -> ConvertedData:
+    """ PDFをメモリ上で画像に変換する. 複数ページの場合は、ページ番号をページ名とする """
+    pages: List[Image.Image] = pdf2image.convert_from_bytes(data, **pdf2image_options, poppler_path=POPPLER_PATH)
+    if len(pages) == 1:
+        return [(None, save_to_bytes(pages[0], output_suffix, preprocessor.byte_budget))]
+
+    return [(str(i), save_to_bytes(page, output_suffix, preprocessor.byte_budget)) for i, page in enumerate(pages)]
+
+
+def extract_icon_data(data: bytes, output_suffix: str, preprocessor: Preprocessor,
+                      _pdf2image_options: Dict[str, Any], icon_options: Dict[str, Any]) -> ConvertedData:
+    """ メモリ上のPEファイルからiconを取り出す """
+    extractor = IconExtractor("<memory>", logger, data=data)
+    return [(None, export_icon_data(extractor, output_suffix, preprocessor=preprocessor, **icon_options))]
+
+
+def passthrough(input_format: str, img_input: Path, img_output: Path, preprocessor: Preprocessor,
+                _pdf2image_options: Dict[str, Any], _icon_options: Dict[str, Any]) -> bool:
+    """ 画素を触らずに、バイト列のままコピーする. 必要ならメタデータだけを取り除く """
+    try:
+        if preprocessor.strip_metadata and can_strip_metadata(input_format):
+            strip_metadata(img_input, img_output, input_format)
+
+        else:
+            warn_unstrippable_metadata(input_format, preprocessor, str(img_input))
+            copy_file(img_input, img_output)
+
+    except (ValueError, OSError) as err:
+        logger.error("failed to convert!")
+        logger.exception(err)
+        return False
+
+    logger.info(f"successfully copied {img_input} into {img_output} without decoding")
+    return True
+
+
+def passthrough_data(input_format: str, data: bytes, _output_suffix: str, preprocessor: Preprocessor,
+                     _pdf2image_options: Dict[str, Any], _icon_options: Dict[str, Any]) -> ConvertedData:
+    """ メモリ上のデータをそのまま返す. 必要ならメタデータだけを取り除く """
+    if preprocessor.strip_metadata and can_strip_metadata(input_format):
+        data = strip_metadata_from_bytes(data, input_format)
+
+    else:
+        warn_unstrippable_metadata(input_format, preprocessor, "the input")
+
+    return [(None, data)]
+
+
+def warn_unstrippable_metadata(input_format: str, preprocessor: Preprocessor, name: str):
+    """ メタデータを取り除けない形式を、そのままコピーする時に警告する """
+    if preprocessor.strip_metadata:
+        logger.warning(f"metadata of {input_format} cannot be stripped without re-encoding, "
+                       f"so {name} is copied as it is.")
+
+
+def can_passthrough(preprocessor: Preprocessor) -> bool:
+    """画素を触らずに変換できる前処理の指定か
+
+    メタデータを取り除けない形式(GIF, WebP, TIFFなど)は、再エンコードでアニメーションや画質を失わないよう、
+    --strip-metadataが指定されていても警告してそのままコピーする。
+    """
+    return not preprocessor.needs_pixel_work and preprocessor.byte_budget is None
+
+
+def register_passthrough_backends(registry: ConverterRegistry):
+    """ 同じコンテナへの変換を、バイト列のままコピーするバックエンドを形式ごとに登録する """
+    for input_format in sorted(set(PASSTHROUGH_SUFFIXES.values())):
+        registry.register(ConverterBackend(
+            "passthrough",
+            frozenset({input_format}),
+            partial(passthrough, input_format),
+            partial(is_same_container, input_format),
+            cost=0,
+            can_preprocess=can_passthrough,
+            convert_data=partial(passthrough_data, input_format)))
+
+
+CONVERTERS = ConverterRegistry()
+register_passthrough_backends(CONVERTERS)
+CONVERTERS.register(ConverterBackend(
+    "pillow",
+    # requirements.txtで固定しているpillow 9.3で開ける形式. QOIの読み込みは9.5からなので含めない
+    frozenset({"bmp", "cur", "eps", "gif", "icns", "ico", "im", "jpeg", "jpeg2000", "msp", "pcx", "png", "ppm", "psd",
+               "sgi", "tiff", "webp", "xbm"}),
+    convert_image_by_pillow,
+    can_save_by_pillow,
+    cost=10,
+    convert_data=convert_image_data))
+CONVERTERS.register(ConverterBackend("pdf2image", frozenset({"pdf"}), convert_pdf_by_pdf2image, can_save_by_pillow,
+                                     cost=20, convert_data=convert_pdf_data))
+CONVERTERS.register(ConverterBackend("iconextractor", frozenset({"pe"}), extract_icon_from_pe, can_save_by_pillow,
+                                     cost=10, convert_data=extract_icon_data))
+
+
+def convert(img_input: Path, img_output: Path, preprocessor: Preprocessor, pdf2image_options: Dict[str, Any],
+            icon_options: Dict[str, Any]) -> bool:
+    """入力の形式を先頭のバイト列から判別し、登録されたバックエンドで変換する
+
+    Args:
+        img_input (Path): 入力ファイル
+        img_output (Path): 出力ファイルパス
+        preprocessor (Preprocessor): 前処理用インスタンス
+        pdf2image_options (Dict[str, Any]): pdf2imageに渡すオプション
+        icon_options (Dict[str, Any]): extract_iconに渡すオプション
+
+    Returns:
+        bool: 変換に成功した場合はTrue
+    """
+    input_format = sniff_format(img_input)
+    if input_format is None:
+        logger.error(f"could not identify the format of {img_input}, so it is skipped.")
+        return False
+
+    backend = CONVERTERS.find(input_format, img_output.suffix, preprocessor)
+    if backend is None:
+        logger.error(f"The conversion from {input_format} ({img_input}) into {img_output.suffix} "
+                     "is not permitted now...")
+        return False
+
+    logger.debug(f"{img_input} is identified as {input_format}, and converted by {backend.name}")
+    return backend.convert(img_input, img_output, preprocessor, pdf2image_options, icon_options)
+
+
+def convert_data(data: bytes, name: str, output_suffix: str, preprocessor: Preprocessor,
+                 pdf2image_options: Dict[str, Any], icon_options: Dict[str, Any]) -> Optional[ConvertedData]:
+    """メモリ上のデータの形式を判別し、登録されたバックエンドでメモリ上で変換する
+
+    壊れたデータなどで変換に失敗しても、ログに出してNoneを返し、残りの変換を続けられるようにする。
+
+    Args:
+        data (bytes): 入力データ
+        name (str): ログに出す入力の名前
+        output_suffix (str): 出力の拡張子
+        preprocessor (Preprocessor): 前処理用インスタンス
+        pdf2image_options (Dict[str, Any]): pdf2imageに渡すオプション
+        icon_options (Dict[str, Any]): extract_iconに渡すオプション
+
+    Returns:
+        Optional[ConvertedData]: 変換した結果. 失敗した場合はNone
+    """
+    input_format = sniff_format_from_bytes(data[:HEAD_SIZE])
+    if input_format is None:
+        logger.error(f"could not identify the format of {name}, so it is skipped.")
+        return None
+
+    backend = CONVERTERS.find(input_format, output_suffix, preprocessor, in_memory=True)
+    if backend is None or backend.convert_data is None:
+        logger.error(f"The conversion from {input_format} ({name}) into {output_suffix} is not permitted now...")
+        return None
+
+    logger.debug(f"{name} is identified as {input_format}, and converted by {backend.name} in memory")
+    try:
+        return backend.convert_data(data, output_suffix, preprocessor, pdf2image_options, icon_options)
+
+    except (UnidentifiedImageError, ValueError, OSError, IconExtractorError) as err:
+        logger.error(f"failed to convert {name}: {err}")
+        return None
+
+
+def write_outputs(outputs: ConvertedData, name: str, img_output: PurePath,
+                  writer: Optional[ArchiveWriter]):
+    """convert_dataの結果を、アーカイブのメンバーまたはファイルとして書き出す
+
+    Args:
+        outputs (ConvertedData): convert_dataの返り値
+        name (str): ログに出す入力の名前
+        img_output (PurePath): 出力先. アーカイブに書き出す場合はメンバー名。
+        writer (Optional[ArchiveWriter]): 書き出し先のアーカイブ. Noneならファイルに書き出す。
+    """
+    for page, data in outputs:
+        # 複数ページの場合は、convert_pdfと同じく拡張子を除いたフォルダにページ番号で書き出す
+        output = img_output if page is None else img_output.with_name(img_output.stem) / f"{page}{img_output.suffix}"
+
+        if writer is not None:
+            if not writer.write(output.as_posix(), data):
+                logger.warning(f"{output} already exists in {writer.path}, so it is skipped.")
+                continue
+            logger.info(f"successfully converted {name} into {writer.path}/{output.as_posix()}")
+
+        else:
+            path = Path(output)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+            logger.info(f"successfully converted {name} into {path}")
+
+
+def run_task(worker: Optional[IsolatedWorker], name: str, func: Callable[..., Any], *args: Any) -> TaskResult:
+    """ workerがあれば子プロセスで、無ければこのプロセスでfunc(*args)を実行する """
+    if worker is None:
+        return TaskResult(True, "", func(*args))
+
+    result = worker.call(func, *args)
+    if not result.ok:
+        logger.error(f"failed to process {name}: {result.reason}")
+
+    return result
+
+
+def convert_archive(archive: Path, out: str, writer: Optional[ArchiveWriter], worker: Optional[IsolatedWorker],
+                    options: Tuple[Preprocessor, Dict[str, Any], Dict[str, Any]]) -> bool:
+    """アーカイブのメンバーを、展開せずにメモリ上で変換する
+
+    Args:
+        archive (Path): 入力のアーカイブ
+        out (str): 出力先の情報. writerがある場合はアーカイブ内のメンバー名。${stem}, ${dir}はメンバーのパスで置き換える。
+        writer (Optional[ArchiveWriter]): 書き出し先のアーカイブ. Noneならファイルに書き出す。
+        worker (Optional[IsolatedWorker]): 変換を行う子プロセス. Noneならこのプロセスで変換する。
+        options (Tuple[Preprocessor, Dict[str, Any], Dict[str, Any]]): 前処理用インスタンス, pdf2image, extract_iconのオプション
+
+    Returns:
+        bool: 全てのメンバーの変換に成功した場合はTrue. アーカイブが壊れていて読めなかった場合もFalse
+    """
+    # 子プロセスのメモリ上限を超えるメンバーは、このプロセスで展開する前に失敗とする(zip bomb対策)
+    max_member_size = None
+    if worker is not None and worker.max_memory is not None:
+        max_member_size = worker.max_memory * 1024 * 1024
+
+    ok = True
+    try:
+        for member, stream in iter_archive_members(archive):
+            name = f"{archive}/{member}"
+            if not is_safe_member(member):
+                logger.error(f"{name} points outside of the output, so it is skipped.")
+                ok = False
+                continue
+
+            data = stream.read() if max_member_size is None else stream.read(max_member_size + 1)
+            if max_member_size is not None and len(data) > max_member_size:
+                logger.error(f"{name} is larger than --max-memory when extracted, so it is skipped.")
+                ok = False
+                continue
+
+            if writer is not None:
+                img_output: PurePath = resolve_member_name(member, out)
+            else:
+                img_output = resolve_output_file_path(member, out)
+
+            result = run_task(worker, name, convert_data, data, name, img_output.suffix, *options)
+            if not result.ok or result.value is None:
+                ok = False
+                continue
+
+            write_outputs(result.value, name, img_output, writer)
+
+    except ARCHIVE_ERRORS as err:
+        logger.error(f"failed to read {archive}: {err}")
+        return False
+
+    return ok
+
+
+def write_retry_list(retry_list: Path, failed_inputs: List[Path], options: List[str]):
+    """失敗した入力を、`imgconv @retry_list`で再実行できる形式で書き出す
+
+    Args:
+        retry_list (Path): 書き出し先
+        failed_inputs (List[Path]): 失敗した入力ファイルのリスト
+        options (List[str]): 入力ファイル以外の引数. 同じ出力先・前処理・隔離の設定で再実行できるよう、そのまま書き出す。
+    """
+    if not failed_inputs:
+        if retry_list.exists():
+            retry_list.unlink()
+            logger.info(f"all files are converted, so {retry_list} is removed.")
+        return
+
+    # argparseのfromfile_prefix_charsで読み込めるよう、1行に1引数を書く
+    lines = ["-i", *[str(img_input.absolute()) for img_input in failed_inputs], *options]
+    retry_list.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    logger.warning(f"{len(failed_inputs)} files failed. retry them with `imgconv @{retry_list}`")
+
+
 def main():
     """ エントリーポイント """
     args = parse()
@@ -294,16 +796,64 @@ def main():
     img_inputs = args.inputs
     out = args.output
 
-    preprocessor = Preprocessor(do_crop_center=args.crop, do_round=args.round, round_rate=args.round_rate)
-    pdf2image_options = {"dpi": args.dpi}
-
-    for img_input in get_img_inputs_from_user_inputs(img_inputs):
-        img_output = resolve_output_file_path(img_input, out)
-        if img_input.suffix == ".exe":
-            extract_icon(img_input, img_output)
-
-        else:
-            convert(img_input, img_output, preprocessor, pdf2image_options)
+    byte_budget = None
+    if args.max_bytes is not None:
+        byte_budget = ByteBudget(args.max_bytes, allow_scale=args.allow_scale, jobs=args.max_bytes_jobs)
+    preprocessor = Preprocessor(do_crop_center=args.crop, do_round=args.round, round_rate=args.round_rate,
+                                strip_metadata=args.strip_metadata, byte_budget=byte_budget)
+    # Windowsではpopplerのプロセスをまとめて終了できないので、pdf2imageにもタイムアウトを渡す
+    pdf2image_options = {"dpi": args.dpi, "timeout": args.timeout}
+    icon_options = {"size": args.icon_size, "bit_depth": args.icon_bit_depth}
+    options = (preprocessor, pdf2image_options, icon_options)
+
+    archive_path, member_pattern = split_archive_path(out)
+    use_worker = args.timeout is not None or args.max_memory is not None or args.retry_list is not None
+
+    # 出力先のアーカイブを開く前に入力を列挙し、書き込み中のアーカイブを入力として拾わないようにする
+    img_input_list = list(get_img_inputs_from_user_inputs(img_inputs))
+
+    failed_inputs: List[Path] = []
+    with ExitStack() as stack:
+        worker: Optional[IsolatedWorker] = None
+        if use_worker:
+            worker = stack.enter_context(IsolatedWorker(logger, timeout=args.timeout, max_memory=args.max_memory,
+                                                        max_tasks=args.max_tasks_per_worker))
+        writer: Optional[ArchiveWriter] = None
+        if archive_path is not None:
+            writer = stack.enter_context(ArchiveWriter(archive_path))
+
+        for img_input in img_input_list:
+            if not img_input.is_file():
+                # globに一致したディレクトリなど
+                logger.error(f"{img_input} is not a file, so it is skipped.")
+                continue
+
+            if archive_path is not None and img_input.resolve() == archive_path.resolve():
+                logger.error(f"{img_input} is the output archive itself, so it is skipped.")
+                continue
+
+            if is_archive(img_input):
+                ok = convert_archive(img_input, member_pattern, writer, worker, options)
+
+            elif writer is not None:
+                img_output = resolve_member_name(to_member_path(img_input), member_pattern)
+                result = run_task(worker, str(img_input), convert_data,
+                                  img_input.read_bytes(), str(img_input), img_output.suffix, *options)
+                ok = result.ok and result.value is not None
+                if ok:
+                    write_outputs(result.value, str(img_input), img_output, writer)
+
+            else:
+                img_output = resolve_output_file_path(img_input, out)
+                result = run_task(worker, str(img_input), convert, img_input, img_output, *options)
+                # 変換関数がエラーを握りつぶして失敗を返した場合も、失敗として記録する
+                ok = result.ok and bool(result.value)
+
+            if not ok:
+                failed_inputs.append(img_input)
+
+    if args.retry_list is not None:
+        write_retry_list(Path(args.retry_list), failed_inputs, format_options(args))
 
 
 if __name__ == '__main__':
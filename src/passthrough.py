@@ -0,0 +1,297 @@
+"""
+画素を触らずに、バイト列のまま画像をコピー・加工するモジュール。
+"""
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Optional
+import io
+import os
+import shutil
+import struct
+import sys
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    # Windowsにはfcntlモジュールが無いため、reflinkは使えない
+    fcntl = None     # pylint: disable=invalid-name
+
+# linux/fs.hで定義されているioctlの番号
+FICLONE = 0x40049409
+
+BLOCK_SIZE = 1024 * 1024
+
+# 出力の拡張子と、同じコンテナとみなす形式名の対応
+PASSTHROUGH_SUFFIXES: Dict[str, str] = {
+    ".bmp": "bmp",
+    ".gif": "gif",
+    ".icns": "icns",
+    ".ico": "ico",
+    ".jfif": "jpeg",
+    ".jpe": "jpeg",
+    ".jpeg": "jpeg",
+    ".jpg": "jpeg",
+    ".pdf": "pdf",
+    ".png": "png",
+    ".tif": "tiff",
+    ".tiff": "tiff",
+    ".webp": "webp",
+}
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# 表示に影響しないチャンク. 色やαに関わるチャンク(iCCP, gAMA, tRNSなど)は残す
+# eXIfは向き(Orientation)に関わるので、Orientationだけを残したものに置き換える
+PNG_METADATA_CHUNKS = {b"tEXt", b"zTXt", b"iTXt", b"eXIf", b"tIME"}
+PNG_EXIF_CHUNK = b"eXIf"
+
+# APP1(Exif, XMP), APP13(IPTC), COM. ICCプロファイル(APP2)やAdobe(APP14)は色に関わるので残す
+# Exifは向き(Orientation)に関わるので、Orientationだけを残したものに置き換える
+JPEG_METADATA_MARKERS = {0xE1, 0xED, 0xFE}
+JPEG_APP1 = 0xE1
+JPEG_EXIF_HEADER = b"Exif\x00\x00"
+# 長さを持たないマーカー. TEM, RST0~7
+JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}
+JPEG_SOS = 0xDA
+JPEG_EOI = 0xD9
+
+EXIF_ORIENTATION = 0x0112
+EXIF_TYPE_SHORT = 3
+
+
+def is_same_container(input_format: str, suffix: str) -> bool:
+    """ 入力の形式と出力の拡張子が、同じコンテナを指すか """
+    return PASSTHROUGH_SUFFIXES.get(suffix.lower()) == input_format
+
+
+def is_same_file(src: Path, dst: Path) -> bool:
+    """ 入力と出力が同じファイルか """
+    return dst.exists() and os.path.samefile(src, dst)
+
+
+def _copy_bytes(fsrc: BinaryIO, fdst: BinaryIO, size: int):
+    """ fsrcからfdstへsizeバイトをコピーする. 途中でファイルが終わっている場合はValueErrorを送出する """
+    while size > 0:
+        buf = fsrc.read(min(size, BLOCK_SIZE))
+        if not buf:
+            raise ValueError("unexpected end of file")
+        fdst.write(buf)
+        size -= len(buf)
+
+
+def _read_exact(fsrc: BinaryIO, size: int, file_format: str) -> bytes:
+    """ fsrcからちょうどsizeバイトを読む. 途中でファイルが終わっている場合はValueErrorを送出する """
+    buf = fsrc.read(size)
+    if len(buf) != size:
+        raise ValueError(f"truncated {file_format}")
+    return buf
+
+
+def _try_reflink(fsrc: BinaryIO, fdst: BinaryIO) -> bool:
+    """ reflink(FICLONE)でコピーする. 対応していないファイルシステムではFalseを返す """
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        return False
+
+    return True
+
+
+def _try_copy_file_range(fsrc: BinaryIO, fdst: BinaryIO) -> bool:
+    """ copy_file_rangeでカーネル内でコピーする. 使えない場合はFalseを返す """
+    if not hasattr(os, "copy_file_range"):
+        return False
+
+    copied = 0
+    while True:
+        try:
+            n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), BLOCK_SIZE * 64)
+        except OSError:
+            if copied == 0:
+                return False
+            raise
+
+        if n == 0:
+            return True
+        copied += n
+
+
+def copy_file(src: Path, dst: Path):
+    """ファイルのバイト列をそのままコピーする
+
+    reflink, copy_file_range, 通常の読み書きの順に、使えるものでコピーする。
+
+    Args:
+        src (Path): コピー元
+        dst (Path): コピー先
+    """
+    if is_same_file(src, dst):
+        return
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if _try_reflink(fsrc, fdst) or _try_copy_file_range(fsrc, fdst):
+            return
+        shutil.copyfileobj(fsrc, fdst, BLOCK_SIZE)
+
+
+def _read_exif_orientation(tiff: bytes) -> Optional[int]:
+    """TIFF形式のExifから、IFD0のOrientationを読む
+
+    Args:
+        tiff (bytes): TIFFヘッダから始まるExifのデータ
+
+    Returns:
+        Optional[int]: Orientationの値. 無い場合や読めない場合はNone
+    """
+    if tiff[:4] == b"II*\x00":
+        endian = "<"
+    elif tiff[:4] == b"MM\x00*":
+        endian = ">"
+    else:
+        return None
+
+    try:
+        (offset,) = struct.unpack_from(f"{endian}I", tiff, 4)
+        (count,) = struct.unpack_from(f"{endian}H", tiff, offset)
+        for i in range(count):
+            tag, value_type, _, value = struct.unpack_from(f"{endian}HHI4s", tiff, offset + 2 + i * 12)
+            if tag == EXIF_ORIENTATION and value_type == EXIF_TYPE_SHORT:
+                return struct.unpack_from(f"{endian}H", value)[0]
+    except struct.error:
+        return None
+
+    return None
+
+
+def _build_orientation_exif(orientation: int) -> bytes:
+    """ Orientationだけを持つ、TIFF形式の最小のExifを作る """
+    # ヘッダ, IFD0のエントリ数, Orientationのエントリ(SHORTが1つ), 次のIFDのオフセット
+    return b"MM\x00*" + struct.pack(">IHHHIHHI", 8, 1, EXIF_ORIENTATION, EXIF_TYPE_SHORT, 1, orientation, 0, 0)
+
+
+def _minimize_exif(tiff: bytes) -> Optional[bytes]:
+    """ 画像が回転して表示されないよう、Orientationだけを残したExifを返す. 残す必要が無ければNone """
+    orientation = _read_exif_orientation(tiff)
+    if orientation is None or orientation == 1:
+        return None
+
+    return _build_orientation_exif(orientation)
+
+
+def _strip_png_metadata(fsrc: BinaryIO, fdst: BinaryIO):
+    """ PNGからテキストやExifなどのチャンクを取り除く """
+    signature = fsrc.read(len(PNG_SIGNATURE))
+    if signature != PNG_SIGNATURE:
+        raise ValueError("not a PNG file")
+    fdst.write(signature)
+
+    while True:
+        # IENDより前にファイルが終わっている場合も、途中で切れたものとして扱う
+        header = _read_exact(fsrc, 8, "PNG")
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == PNG_EXIF_CHUNK:
+            exif = _minimize_exif(_read_exact(fsrc, length, "PNG"))
+            _read_exact(fsrc, 4, "PNG")
+            if exif is not None:
+                fdst.write(struct.pack(">I4s", len(exif), chunk_type))
+                fdst.write(exif)
+                fdst.write(struct.pack(">I", zlib.crc32(chunk_type + exif)))
+            continue
+
+        if chunk_type in PNG_METADATA_CHUNKS:
+            # データとCRCを読み飛ばす
+            fsrc.seek(length + 4, os.SEEK_CUR)
+            continue
+
+        fdst.write(header)
+        _copy_bytes(fsrc, fdst, length + 4)
+        if chunk_type == b"IEND":
+            break
+
+
+def _strip_jpeg_metadata(fsrc: BinaryIO, fdst: BinaryIO):
+    """ JPEGからExifやコメントなどのセグメントを取り除く """
+    soi = fsrc.read(2)
+    if soi != b"\xff\xd8":
+        raise ValueError("not a JPEG file")
+    fdst.write(soi)
+
+    while True:
+        marker = _read_exact(fsrc, 2, "JPEG")
+        if marker[0] != 0xFF:
+            fdst.write(marker)
+            break
+
+        code = marker[1]
+        if code in (JPEG_SOS, JPEG_EOI):
+            # 以降は画像データなので、そのままコピーする
+            fdst.write(marker)
+            break
+
+        if code in JPEG_STANDALONE_MARKERS:
+            fdst.write(marker)
+            continue
+
+        length_bytes = _read_exact(fsrc, 2, "JPEG")
+        (length,) = struct.unpack(">H", length_bytes)
+        if length < 2:
+            raise ValueError("invalid JPEG segment length")
+
+        if code == JPEG_APP1:
+            segment = _read_exact(fsrc, length - 2, "JPEG")
+            if segment.startswith(JPEG_EXIF_HEADER):
+                exif = _minimize_exif(segment[len(JPEG_EXIF_HEADER):])
+                if exif is not None:
+                    fdst.write(marker + struct.pack(">H", len(JPEG_EXIF_HEADER) + len(exif) + 2))
+                    fdst.write(JPEG_EXIF_HEADER + exif)
+            continue
+
+        if code in JPEG_METADATA_MARKERS:
+            fsrc.seek(length - 2, os.SEEK_CUR)
+            continue
+
+        fdst.write(marker + length_bytes)
+        _copy_bytes(fsrc, fdst, length - 2)
+
+    shutil.copyfileobj(fsrc, fdst, BLOCK_SIZE)
+
+
+METADATA_STRIPPERS: Dict[str, Callable[[BinaryIO, BinaryIO], None]] = {
+    "png": _strip_png_metadata,
+    "jpeg": _strip_jpeg_metadata,
+}
+
+
+def can_strip_metadata(input_format: str) -> bool:
+    """ 画素を触らずにメタデータを取り除ける形式か """
+    return input_format in METADATA_STRIPPERS
+
+
+def strip_metadata(src: Path, dst: Path, input_format: str):
+    """画素を触らずに、メタデータを取り除いたファイルを書き出す
+
+    入力と出力が同じファイルでも良いように、一時ファイルに書いてから置き換える。
+
+    Args:
+        src (Path): 入力ファイル
+        dst (Path): 出力ファイル
+        input_format (str): 入力の形式名. can_strip_metadataがTrueになるもの。
+    """
+    tmp = dst.with_name(f".{dst.name}.tmp")
+    try:
+        with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+            METADATA_STRIPPERS[input_format](fsrc, fdst)
+        os.replace(tmp, dst)
+
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def strip_metadata_from_bytes(data: bytes, input_format: str) -> bytes:
+    """ メモリ上のデータから、画素を触らずにメタデータを取り除く """
+    fdst = io.BytesIO()
+    METADATA_STRIPPERS[input_format](io.BytesIO(data), fdst)
+    return fdst.getvalue()
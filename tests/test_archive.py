@@ -0,0 +1,153 @@
+# pylint: skip-file
+from pathlib import Path, PurePosixPath
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+
+from PIL import Image
+
+from dist.imgconv import (ArchiveWriter, Preprocessor, convert_archive, convert_data, is_safe_member,
+                          iter_archive_members, resolve_member_name, split_archive_path)
+
+
+class TestSplitArchivePath(unittest.TestCase):
+    def test_not_archive(self):
+        out = "${dir}/${stem}.png"
+        self.assertEqual(split_archive_path(out), (None, out))
+
+    def test_archive(self):
+        self.assertEqual(split_archive_path("out/images.tar.gz/${dir}/${stem}.png"),
+                         (Path("out/images.tar.gz"), "${dir}/${stem}.png"))
+
+    def test_no_member(self):
+        with self.assertRaises(ValueError):
+            split_archive_path("images.zip")
+
+    def test_member_name(self):
+        self.assertEqual(resolve_member_name(PurePosixPath("icons/app.png"), "${dir}/${stem}.ico"),
+                         PurePosixPath("icons/app.ico"))
+        self.assertEqual(resolve_member_name(PurePosixPath("app.png"), "${dir}/${stem}.ico"),
+                         PurePosixPath("app.ico"))
+
+
+class TestArchiveRoundTrip(unittest.TestCase):
+    def test_zip_and_tar(self):
+        for name in ["bundle.zip", "bundle.tar.gz"]:
+            with self.subTest(name=name), tempfile.TemporaryDirectory() as tmp:
+                archive = Path(tmp) / name
+                with ArchiveWriter(archive) as writer:
+                    self.assertTrue(writer.write("a/b.bin", b"data"))
+                    self.assertFalse(writer.write("a/b.bin", b"other"))
+
+                members = [(member, stream.read()) for member, stream in iter_archive_members(archive)]
+                self.assertEqual(members, [(PurePosixPath("a/b.bin"), b"data")])
+
+    def test_keep_existing_members(self):
+        for name in ["bundle.zip", "bundle.tar.gz"]:
+            with self.subTest(name=name), tempfile.TemporaryDirectory() as tmp:
+                archive = Path(tmp) / name
+                with ArchiveWriter(archive) as writer:
+                    writer.write("a.bin", b"old")
+                    writer.write("b.bin", b"old")
+
+                with ArchiveWriter(archive) as writer:
+                    writer.write("b.bin", b"new")
+                    # 閉じるまでは、元のアーカイブはそのまま読める
+                    self.assertEqual(len(list(iter_archive_members(archive))), 2)
+
+                members = {member.as_posix(): stream.read() for member, stream in iter_archive_members(archive)}
+                self.assertEqual(members, {"a.bin": b"old", "b.bin": b"new"})
+                self.assertEqual([p.name for p in Path(tmp).iterdir()], [name])
+
+    def test_refuse_broken_archive(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            archive = Path(tmp) / "bundle.zip"
+            archive.write_bytes(b"not a zip")
+
+            with self.assertRaises(ValueError):
+                ArchiveWriter(archive)
+            self.assertEqual(archive.read_bytes(), b"not a zip")
+
+
+class TestConvertData(unittest.TestCase):
+    def test_convert_in_memory(self):
+        data = Path("./example/single_color.jpg").read_bytes()
+        outputs = convert_data(data, "single_color.jpg", ".png", Preprocessor(do_crop_center=True), {}, {})
+
+        self.assertEqual(len(outputs), 1)
+        page, converted = outputs[0]
+        self.assertIsNone(page)
+        with Image.open(io.BytesIO(converted)) as image:
+            self.assertEqual(image.format, "PNG")
+            self.assertEqual(image.size[0], image.size[1])
+
+    def test_unknown_format(self):
+        self.assertIsNone(convert_data(b"garbage", "garbage.txt", ".png", Preprocessor(), {}, {}))
+
+    def test_continue_after_broken_member(self):
+        data = Path("./example/single_color.jpg").read_bytes()
+        with tempfile.TemporaryDirectory() as tmp:
+            archive = Path(tmp) / "in.zip"
+            with ArchiveWriter(archive) as writer:
+                writer.write("a_broken.jpg", data[:len(data) // 2])
+                writer.write("b.jpg", data)
+
+            out = Path(tmp) / "out.zip"
+            with ArchiveWriter(out) as writer:
+                ok = convert_archive(archive, "${stem}.png", writer, None, (Preprocessor(), {}, {}))
+
+            self.assertFalse(ok)
+            self.assertEqual([member.name for member, _ in iter_archive_members(out)], ["b.png"])
+
+
+class TestUnsafeMembers(unittest.TestCase):
+    def test_is_safe_member(self):
+        self.assertTrue(is_safe_member(PurePosixPath("icons/app.png")))
+        self.assertFalse(is_safe_member(PurePosixPath("../../escaped.jpg")))
+        self.assertFalse(is_safe_member(PurePosixPath("icons/../../escaped.jpg")))
+        self.assertFalse(is_safe_member(PurePosixPath("/tmp/abs.jpg")))
+        self.assertFalse(is_safe_member(PurePosixPath("C:/abs.jpg")))
+        self.assertFalse(is_safe_member(PurePosixPath("..\\escaped.jpg")))
+
+    def test_skip_unsafe_members(self):
+        data = Path("./example/single_color.jpg").read_bytes()
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp) / "out"
+            root.mkdir()
+            archive = root / "bundle.tar"
+            with tarfile.open(archive, "w") as tf:
+                for name in ["../escaped.jpg", f"{tmp}/abs.jpg", "safe.jpg"]:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    tf.addfile(info, io.BytesIO(data))
+
+            cwd = os.getcwd()
+            os.chdir(root)
+            try:
+                ok = convert_archive(archive, "${dir}/${stem}.png", None, None, (Preprocessor(), {}, {}))
+            finally:
+                os.chdir(cwd)
+
+            self.assertFalse(ok)
+            self.assertTrue((root / "safe.png").exists())
+            self.assertEqual(sorted(p.name for p in Path(tmp).rglob("*.png")), ["safe.png"])
+
+
+class TestBrokenArchive(unittest.TestCase):
+    def test_broken_archives(self):
+        data = Path("./example/single_color.jpg").read_bytes()
+        for name in ["bundle.zip", "bundle.tar.gz"]:
+            with self.subTest(name=name), tempfile.TemporaryDirectory() as tmp:
+                archive = Path(tmp) / name
+                with ArchiveWriter(archive) as writer:
+                    writer.write("a.jpg", data)
+                # 途中で切れたアーカイブ
+                archive.write_bytes(archive.read_bytes()[:archive.stat().st_size // 2])
+
+                out = Path(tmp) / "out.zip"
+                with ArchiveWriter(out) as writer:
+                    ok = convert_archive(archive, "${stem}.png", writer, None, (Preprocessor(), {}, {}))
+
+                self.assertFalse(ok)
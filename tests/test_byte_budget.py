@@ -0,0 +1,71 @@
+# pylint: skip-file
+from pathlib import Path
+import tempfile
+import unittest
+
+from PIL import Image
+
+from dist.imgconv import ByteBudget, Preprocessor, convert, encode_image, fit_to_budget, logger, search_largest_fit
+
+
+class TestByteBudget(unittest.TestCase):
+    def setUp(self):
+        self.image = Image.open("./example/hakase4_laugh.png").convert("RGB")
+
+    def test_search_largest_fit(self):
+        for jobs in (1, 3):
+            with self.subTest(jobs=jobs):
+                found, attempts = search_largest_fit(1, 100, lambda v: b"x" * v, 42,
+                                                     executor=None if jobs == 1 else _SerialExecutor(), jobs=jobs)
+                self.assertEqual(found, (42, b"x" * 42))
+                self.assertLess(attempts, 100)
+
+    def test_fit_quality(self):
+        full = len(encode_image(self.image, "JPEG", 95))
+        budget = ByteBudget(full // 2)
+
+        result = fit_to_budget(self.image, "JPEG", budget)
+
+        self.assertIsNotNone(result.data)
+        self.assertLessEqual(len(result.data), budget.max_bytes)
+        self.assertLess(result.quality, 95)
+        self.assertEqual(result.scale, 100)
+        self.assertGreater(result.attempts, 0)
+
+    def test_parallel_search_gives_same_quality(self):
+        budget = ByteBudget(len(encode_image(self.image, "JPEG", 95)) // 2)
+
+        serial = fit_to_budget(self.image, "JPEG", budget)
+        parallel = fit_to_budget(self.image, "JPEG", budget._replace(jobs=4))
+
+        self.assertEqual(parallel.quality, serial.quality)
+        self.assertEqual(parallel.data, serial.data)
+
+    def test_scale_only_when_allowed(self):
+        budget = ByteBudget(len(encode_image(self.image, "PNG")) // 4)
+
+        self.assertIsNone(fit_to_budget(self.image, "PNG", budget).data)
+
+        result = fit_to_budget(self.image, "PNG", budget._replace(allow_scale=True))
+        self.assertIsNotNone(result.data)
+        self.assertLessEqual(len(result.data), budget.max_bytes)
+        self.assertLess(result.scale, 100)
+
+    def test_unreachable_budget_is_reported(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            img_output = Path(tmp) / "out.png"
+            preprocessor = Preprocessor(byte_budget=ByteBudget(300))
+            with self.assertLogs(logger, "INFO") as logs:
+                ok = convert(Path("./example/hakase4_laugh.png"), img_output, preprocessor, {}, {})
+
+        self.assertFalse(ok)
+        self.assertFalse(img_output.exists())
+        self.assertEqual([record.levelname for record in logs.records], ["ERROR"])
+        self.assertIsNone(logs.records[0].exc_info)
+
+
+class _SerialExecutor:
+    """ 同時に試す時の分割を、スレッド無しで確かめるためのExecutor """
+
+    def map(self, func, iterable):
+        return map(func, iterable)
@@ -0,0 +1,32 @@
+# pylint: skip-file
+import unittest
+
+from dist.imgconv import CONVERTERS, ConverterBackend, ConverterRegistry
+
+
+def noop(*args):
+    pass
+
+
+class TestConverterRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = ConverterRegistry()
+        self.registry.register(ConverterBackend("slow", frozenset({"png", "jpeg"}), noop, cost=10))
+        self.registry.register(ConverterBackend("fast", frozenset({"png"}), noop, lambda s: s == ".png", cost=0))
+
+    def test_cheapest_backend(self):
+        self.assertEqual(self.registry.find("png", ".png").name, "fast")
+
+    def test_fallback_by_output(self):
+        self.assertEqual(self.registry.find("png", ".ico").name, "slow")
+
+    def test_unsupported(self):
+        self.assertIsNone(self.registry.find("pdf", ".png"))
+        self.assertEqual(self.registry.supported_formats(), {"png", "jpeg"})
+
+
+class TestRegisteredConverters(unittest.TestCase):
+    def test_qoi_is_rejected_before_decoding(self):
+        # 固定しているpillowでは開けないので、どのバックエンドにも渡さない
+        self.assertIsNone(CONVERTERS.find("qoi", ".png"))
+        self.assertEqual(CONVERTERS.find("png", ".jpg").name, "pillow")
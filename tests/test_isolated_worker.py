@@ -0,0 +1,96 @@
+# pylint: skip-file
+from pathlib import Path
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from dist.imgconv import IsolatedWorker
+
+
+def succeed():
+    pass
+
+
+def sleep_forever():
+    time.sleep(60)
+
+
+def spawn_and_sleep(pid_file):
+    # popplerのように、子プロセスがさらに起動したプロセス
+    proc = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    Path(pid_file).write_text(str(proc.pid))
+    time.sleep(60)
+
+
+def raise_error():
+    raise ValueError("broken image")
+
+
+def crash():
+    os._exit(3)
+
+
+class TestIsolatedWorker(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger("test")
+
+    def test_success(self):
+        with IsolatedWorker(self.logger) as worker:
+            result = worker.call(succeed)
+
+        self.assertTrue(result.ok)
+
+    def test_timeout(self):
+        with IsolatedWorker(self.logger, timeout=0.5) as worker:
+            result = worker.call(sleep_forever)
+
+        self.assertFalse(result.ok)
+        self.assertIn("timed out", result.reason)
+
+    @unittest.skipUnless(hasattr(os, "killpg"), "process groups are not available")
+    def test_timeout_kills_grandchildren(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pid_file = Path(tmp) / "pid"
+            with IsolatedWorker(self.logger, timeout=1) as worker:
+                result = worker.call(spawn_and_sleep, str(pid_file))
+            self.assertFalse(result.ok)
+
+            pid = int(pid_file.read_text())
+            for _ in range(50):
+                if not _is_running(pid):
+                    break
+                time.sleep(0.1)
+            self.assertFalse(_is_running(pid))
+
+    def test_exception(self):
+        with IsolatedWorker(self.logger) as worker:
+            result = worker.call(raise_error)
+
+        self.assertFalse(result.ok)
+        self.assertIn("ValueError", result.reason)
+
+    def test_crash_and_recover(self):
+        with IsolatedWorker(self.logger) as worker:
+            result = worker.call(crash)
+            self.assertFalse(result.ok)
+            self.assertIn("crashed", result.reason)
+
+            self.assertTrue(worker.call(succeed).ok)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+
+    # 親が先に終了したプロセスは、回収されるまでゾンビとして残る
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().split()[2] != "Z"
+    except FileNotFoundError:
+        return True
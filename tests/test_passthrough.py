@@ -0,0 +1,102 @@
+# pylint: skip-file
+from pathlib import Path
+import tempfile
+import unittest
+
+from PIL import Image, PngImagePlugin
+
+from dist.imgconv import Preprocessor, convert, copy_file, is_same_container, strip_metadata, strip_metadata_from_bytes
+
+
+class TestPassthrough(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+        self.image = Image.new("RGB", (16, 16), "red")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_same_container(self):
+        self.assertTrue(is_same_container("jpeg", ".JPG"))
+        self.assertTrue(is_same_container("jpeg", ".jfif"))
+        self.assertFalse(is_same_container("png", ".ico"))
+
+    def test_copy_file(self):
+        src = Path("./example/hakase4_laugh.png")
+        dst = self.dir / "copy.png"
+        copy_file(src, dst)
+
+        self.assertEqual(dst.read_bytes(), src.read_bytes())
+
+    def test_strip_png_metadata(self):
+        info = PngImagePlugin.PngInfo()
+        info.add_text("Author", "someone")
+        src = self.dir / "meta.png"
+        self.image.save(src, pnginfo=info)
+
+        dst = self.dir / "stripped.png"
+        strip_metadata(src, dst, "png")
+
+        with Image.open(dst) as stripped:
+            self.assertNotIn("Author", stripped.info)
+            self.assertEqual(stripped.tobytes(), self.image.tobytes())
+
+    def test_strip_jpeg_metadata_in_place(self):
+        exif = Image.Exif()
+        exif[0x010e] = "description"
+        src = self.dir / "meta.jpg"
+        self.image.save(src, exif=exif, comment=b"comment")
+        with Image.open(src) as original:
+            pixels = original.tobytes()
+
+        strip_metadata(src, src, "jpeg")
+
+        with Image.open(src) as stripped:
+            self.assertEqual(dict(stripped.getexif()), {})
+            self.assertNotIn("comment", stripped.info)
+            self.assertEqual(stripped.tobytes(), pixels)
+        self.assertEqual(list(self.dir.iterdir()), [src])
+
+    def test_keep_orientation(self):
+        exif = Image.Exif()
+        exif[0x010e] = "description"
+        exif[0x0112] = 6
+        for suffix, fmt in [(".jpg", "jpeg"), (".png", "png")]:
+            with self.subTest(fmt=fmt):
+                src = self.dir / f"rotated{suffix}"
+                self.image.save(src, exif=exif)
+                dst = self.dir / f"stripped{suffix}"
+                strip_metadata(src, dst, fmt)
+
+                with Image.open(dst) as stripped:
+                    self.assertEqual(dict(stripped.getexif()), {0x0112: 6})
+
+    def test_copy_animated_gif_even_if_strip_metadata(self):
+        frames = [Image.new("P", (16, 16), i) for i in range(3)]
+        src = self.dir / "anim.gif"
+        frames[0].save(src, save_all=True, append_images=frames[1:], comment=b"comment")
+
+        dst = self.dir / "out.gif"
+        self.assertTrue(convert(src, dst, Preprocessor(strip_metadata=True), {}, {}))
+
+        self.assertEqual(dst.read_bytes(), src.read_bytes())
+
+    def test_report_failed_copy(self):
+        src = self.dir / "a.png"
+        self.image.save(src)
+
+        self.assertFalse(convert(src, self.dir / "nodir" / "a.png", Preprocessor(), {}, {}))
+
+    def test_truncated_input(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        for suffix, fmt in [(".jpg", "jpeg"), (".png", "png")]:
+            src = self.dir / f"truncated{suffix}"
+            self.image.save(src, exif=exif)
+            data = src.read_bytes()
+            # JPEGはSOS以降の画像データをそのままコピーするので、その手前までで切れているものを試す
+            end = data.index(b"\xff\xda") if fmt == "jpeg" else len(data)
+            for size in range(8, end):
+                with self.subTest(fmt=fmt, size=size), self.assertRaises(ValueError):
+                    strip_metadata_from_bytes(data[:size], fmt)
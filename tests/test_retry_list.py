@@ -0,0 +1,39 @@
+# pylint: skip-file
+from pathlib import Path
+import tempfile
+import unittest
+
+from dist.imgconv import Preprocessor, convert, format_options, parse, write_retry_list
+
+
+class TestRetryList(unittest.TestCase):
+    def test_parse_written_retry_list(self):
+        failed_inputs = [Path("./example/single_color.jpg"), Path("./example/hakase4_laugh.png")]
+        out = "${dir}/${stem}.ico"
+
+        with tempfile.TemporaryDirectory() as tmp:
+            retry_list = Path(tmp) / "retry.txt"
+            args = parse(["-i", "*.jpg", "-o", out, "--crop", "--dpi", "300", "--max-bytes", "50K",
+                          "--timeout", "60", "--retry-list", str(retry_list)])
+            write_retry_list(retry_list, failed_inputs, format_options(args))
+            namespace = parse([f"@{retry_list}"])
+
+        self.assertEqual(namespace.inputs, [str(p.absolute()) for p in failed_inputs])
+        self.assertEqual(vars(namespace), {**vars(args), "inputs": namespace.inputs})
+
+    def test_remove_retry_list_when_no_failure(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            retry_list = Path(tmp) / "retry.txt"
+            retry_list.write_text("-i\nfoo.png\n-o\nbar.ico\n", encoding="utf-8")
+            write_retry_list(retry_list, [], ["-o", "bar.ico"])
+
+            self.assertFalse(retry_list.exists())
+
+    def test_failed_conversion_is_reported(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # RGBAの画像はjpegで保存できないので、エラーはログに出た上で失敗として返る
+            img_output = Path(tmp) / "out.jpg"
+            ok = convert(Path("./example/hakase4_laugh.png"), img_output, Preprocessor(), {}, {})
+
+            self.assertFalse(ok)
+            self.assertFalse(img_output.exists())
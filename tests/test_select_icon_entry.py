@@ -0,0 +1,74 @@
+# pylint: skip-file
+from types import SimpleNamespace
+import io
+import struct
+import unittest
+
+from PIL import Image, PngImagePlugin
+
+from dist.imgconv import IconExtractor, IconNotFoundError, Preprocessor, export_icon_data
+
+
+def entry(width, bit_count, icon_id):
+    e = SimpleNamespace(Width=width, BitCount=bit_count, ID=icon_id)
+    e.__pack__ = lambda: struct.pack("<BBBBHHIH", width, width, 0, 0, 1, bit_count, 0, icon_id)
+    return e
+
+
+def png_icon(width):
+    info = PngImagePlugin.PngInfo()
+    info.add_text("Software", "test")
+    buf = io.BytesIO()
+    Image.new("RGBA", (width, width), "blue").save(buf, format="PNG", pnginfo=info)
+    return buf.getvalue()
+
+
+class TestSelectIconEntry(unittest.TestCase):
+    def setUp(self):
+        self.extractor = IconExtractor.__new__(IconExtractor)
+        self.entries = [entry(16, 32, 1), entry(32, 8, 2), entry(32, 32, 3), entry(0, 32, 4)]
+        self.extractor._get_group_icon_entries = lambda num=0: self.entries
+
+    def test_largest_by_default(self):
+        selected = self.extractor.select_icon_entry()
+        self.assertEqual(selected.ID, 4)
+        self.assertEqual(IconExtractor.get_entry_size(selected), 256)
+
+    def test_size(self):
+        self.assertEqual(self.extractor.select_icon_entry(size=32).ID, 3)
+        self.assertEqual(self.extractor.select_icon_entry(size=256).ID, 4)
+
+    def test_size_and_bit_depth(self):
+        self.assertEqual(self.extractor.select_icon_entry(size=32, bit_depth=8).ID, 2)
+
+    def test_not_found(self):
+        with self.assertRaises(IconNotFoundError):
+            self.extractor.select_icon_entry(size=48)
+
+
+class TestExportIconData(unittest.TestCase):
+    def setUp(self):
+        self.extractor = IconExtractor.__new__(IconExtractor)
+        self.entries = [entry(16, 32, 1), entry(32, 32, 2)]
+        self.icons = {1: png_icon(16), 2: png_icon(32)}
+        self.extractor._get_group_icon_entries = lambda num=0: self.entries
+        self.extractor._get_icon_data = lambda ids: [self.icons[i] for i in ids]
+
+    def test_single_entry_into_ico(self):
+        data = export_icon_data(self.extractor, ".ico", size=32)
+
+        with Image.open(io.BytesIO(data)) as icon:
+            self.assertEqual(icon.info["sizes"], {(32, 32)})
+
+    def test_strip_metadata_without_reencoding(self):
+        data = export_icon_data(self.extractor, ".png", size=16, preprocessor=Preprocessor(strip_metadata=True))
+
+        with Image.open(io.BytesIO(data)) as icon:
+            self.assertNotIn("Software", icon.info)
+        self.assertEqual(len(data), len(self.icons[1]) - len(b"Software\x00test") - 12)
+
+    def test_into_format_without_alpha(self):
+        data = export_icon_data(self.extractor, ".jpg", size=32)
+
+        with Image.open(io.BytesIO(data)) as icon:
+            self.assertEqual((icon.format, icon.mode, icon.size), ("JPEG", "RGB", (32, 32)))
@@ -0,0 +1,35 @@
+# pylint: skip-file
+from pathlib import Path
+import unittest
+
+from dist.imgconv import sniff_format, sniff_format_from_bytes
+
+
+class TestSniffFormat(unittest.TestCase):
+    def test_example_files(self):
+        self.assertEqual(sniff_format(Path("./example/single_color.jpg")), "jpeg")
+        self.assertEqual(sniff_format(Path("./example/hakase4_laugh.png")), "png")
+        self.assertEqual(sniff_format(Path("./example/single_color.ico")), "ico")
+
+    def test_not_a_file(self):
+        self.assertIsNone(sniff_format(Path("./example")))
+        self.assertIsNone(sniff_format(Path("./example/not_found.png")))
+
+    def test_signatures(self):
+        cases = {
+            b"GIF89a\x01\x00": "gif",
+            b"%PDF-1.7\n": "pdf",
+            b"MZ\x90\x00": "pe",
+            b"RIFF\x24\x00\x00\x00WEBPVP8 ": "webp",
+            b"II*\x00\x08\x00": "tiff",
+            b"P6\n640 480\n255\n": "ppm",
+            b"\x0a\x05\x01\x08": "pcx",
+        }
+        for head, expected in cases.items():
+            with self.subTest(expected=expected):
+                self.assertEqual(sniff_format_from_bytes(head), expected)
+
+    def test_unknown(self):
+        self.assertIsNone(sniff_format_from_bytes(b"garbage"))
+        self.assertIsNone(sniff_format_from_bytes(b"RIFF\x24\x00\x00\x00WAVEfmt "))
+        self.assertIsNone(sniff_format_from_bytes(b""))